@@ -2,4 +2,9 @@
 from importlib.metadata import version
 __version__ = version("azure_notebook_reporting")
 
-from .azure_notebook_reporting import KQL, BlobPath, azcli
\ No newline at end of file
+from .azure_notebook_reporting import KQL, BlobPath, azcli
+from .loganalytics import LogAnalyticsClient
+from .rendering import RenderPool
+from .simulated import SimulatedBackend
+from .sharedstore import SharedStore
+from .uploads import Uploader
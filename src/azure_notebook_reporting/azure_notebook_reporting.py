@@ -1,25 +1,32 @@
-import json, pandas, seaborn, esparto, tinycss2, tempfile, hashlib, pickle
+from __future__ import annotations
+import io, json, os, threading, time, pandas, pyarrow as pa, tempfile, hashlib, pickle, copy, warnings
 from pathlib import Path
-from typing import Union
+from typing import Union, TYPE_CHECKING
 from string import Template
-from IPython import display
-from cloudpathlib import AzureBlobClient, AnyPath
-from azure.storage.blob import BlobServiceClient
 from datetime import datetime, timedelta
-from subprocess import check_output
+from functools import cached_property, partial
+from subprocess import check_output, run, CalledProcessError
 from cacheout import Cache
-from concurrent.futures import ThreadPoolExecutor, wait, Future
-from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
 from pathvalidate import sanitize_filepath
+from . import loganalytics, rendering, uploads
+from .resultcache import ResultCache
+from .history import HistoryStore
+from .sharedstore import SharedStore
+
+# seaborn, esparto, IPython, cloudpathlib and the azure sdks are imported on first use to keep notebook startup fast
+if TYPE_CHECKING:
+    from cloudpathlib import AnyPath
 
 cache = Cache(maxsize=25600, ttl=300)
 azcli_loggedin = False
+azcli_extensions = set()
 
 
-@cache.memoize()
-def azcli(cmd: list[str], df=False) -> Union[None, bool, dict]:
+def azcli_run(cmd: list[str]) -> bytes:
     """
-    Run an azure cli cmd, trying to login if not already logged in
+    Run an azure cli cmd, trying to login if not already logged in, and return its json output.
+    Failures raise a loganalytics.QueryError classified from the cli's stderr.
     """
     global azcli_loggedin
     if not azcli_loggedin:
@@ -38,44 +45,112 @@ def azcli(cmd: list[str], df=False) -> Union[None, bool, dict]:
             azcli_loggedin = True
     cmd = ["az"] + cmd + ["--only-show-errors", "-o", "json"]
     try:
-        result = check_output(cmd) or "null"
-    except Exception as e:
-        print(e)
-        result, azcli_loggedin = "null".encode(), False
+        return run(cmd, capture_output=True, check=True).stdout or b"null"
+    except CalledProcessError as e:
+        azcli_loggedin = False
+        raise loganalytics.classify_text(e.stderr.decode("utf8", "replace").strip() or str(e))
+    except OSError as e:
+        azcli_loggedin = False
+        raise loganalytics.QueryError(str(e))
+
+
+@cache.memoize()
+def azcli(cmd: list[str], df=False) -> Union[None, bool, dict]:
+    """
+    Run an azure cli cmd, trying to login if not already logged in (failures are printed and return None)
+    """
+    try:
+        result = azcli_run(cmd)
+    except loganalytics.QueryError as e:
+        print(f"{e.kind}: {e}")
+        result = b"null"
     if df:
         return pandas.read_json(result.decode("utf8"))
     else:
         return json.loads(result)
 
 
+def azcli_extension(name: str):
+    """
+    Install an azure cli extension once per environment, skipping the (slow) az extension add
+    if it is already in the cli's extension dir or was added earlier in this process
+    """
+    ext_dir = os.environ.get("AZURE_EXTENSION_DIR") or Path(os.environ.get("AZURE_CONFIG_DIR") or Path.home() / ".azure") / "cliextensions"
+    if name in azcli_extensions or (Path(ext_dir) / name).exists():
+        return
+    azcli(["extension", "add", "-n", name, "-y"])
+    azcli_extensions.add(name)
+
+
+class lazy:
+    "Class attribute computed on first access, then cached on the class"
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, owner):
+        value = self.fn()
+        setattr(owner, self.name, value)
+        return value
+
+
+blob_clients = {}  # (account url, container, subscription) -> (AzureBlobClient, sas expiry)
+blob_clients_lock = threading.Lock()
+
+
 def BlobPath(url: str, subscription: str = ""):
     """
     Mounts a blob url using azure cli
     If called with no subscription, just returns a pathlib.Path pointing to url (for testing)
+    The container's sas (valid for 7 days) and client are reused until a day before the sas expires,
+    so every path and uploads.Uploader share one BlobServiceClient and its connection pool.
     """
     if subscription == "":
         return Path(sanitize_filepath(url))
-    expiry = str(datetime.today().date() + timedelta(days=7))
+    from cloudpathlib import AzureBlobClient
+    from azure.storage.blob import BlobServiceClient
+    from requests import Session
+    from requests.adapters import HTTPAdapter
+
     account, container = url.split("/")[2:]
-    account = account.split(".")[0]
-    sas = azcli(
-        [
-            "storage",
-            "container",
-            "generate-sas",
-            "--account-name",
-            account,
-            "-n",
-            container,
-            "--subscription",
-            subscription,
-            "--permissions",
-            "racwdlt",
-            "--expiry",
-            expiry,
-        ]
-    )
-    blobclient = AzureBlobClient(blob_service_client=BlobServiceClient(account_url=url.replace(f"/{container}", ""), credential=sas))
+    account_url = url.replace(f"/{container}", "")
+    with blob_clients_lock:
+        blobclient, expiry = blob_clients.get((account_url, container, subscription), (None, datetime.today()))
+        if expiry - datetime.today() < timedelta(days=1):
+            expiry = datetime.combine(datetime.today().date() + timedelta(days=7), datetime.min.time())
+            sas = azcli(
+                [
+                    "storage",
+                    "container",
+                    "generate-sas",
+                    "--account-name",
+                    account.split(".")[0],
+                    "-n",
+                    container,
+                    "--subscription",
+                    subscription,
+                    "--permissions",
+                    "racwdlt",
+                    "--expiry",
+                    str(expiry.date()),
+                ]
+            )
+            # enough pooled connections for concurrent block uploads, files over max_single_put_size go up in blocks
+            session = Session()
+            session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+            service = BlobServiceClient(
+                account_url=account_url,
+                credential=sas,
+                session=session,
+                max_block_size=uploads.block_size,
+                max_single_put_size=uploads.max_single_put_size,
+            )
+            blobclient = AzureBlobClient(blob_service_client=service)
+            if sas:
+                blob_clients[(account_url, container, subscription)] = (blobclient, expiry)
     return blobclient.CloudPath(f"az://{container}")
 
 
@@ -99,7 +174,18 @@ class KQL:
     | where count_ > 0
     """
 
-    base_css = tinycss2.parse_stylesheet(open(esparto.options.esparto_css).read())
+    # last seen alert per workspace, sentinel workspaces are those with alerts in alerts_lookback
+    workspace_alerts_kql = """
+    SecurityAlert
+    | summarize LastAlert = max(TimeGenerated) by TenantId
+    """
+    alerts_lookback = "P60D"
+
+    @lazy
+    def base_css():
+        import esparto, tinycss2
+
+        return tinycss2.parse_stylesheet(open(esparto.options.esparto_css).read())
 
     pdf_css = Template(
         """
@@ -166,9 +252,34 @@ class KQL:
     """
     )
 
-    sns = seaborn
+    @lazy
+    def sns():
+        import seaborn
+
+        return seaborn
+
+    # "api" queries in process over a pooled http session, "azcli" shells out to az monitor log-analytics query,
+    # or any callable(chunk, query, timespan) returning an arrow table or dataframe, e.g. simulated.SimulatedBackend()
+    backend = "api"
 
-    def __init__(self, path: Union[Path, AnyPath], template: str = "", subfolder: str = "notebooks", timespan: str = "P30D"):
+    # key for hash_columns pseudonymisation, set per deployment so tokens can't be reversed by hashing known identities
+    hash_salt = os.environ.get("REPORT_HASH_SALT", "")
+    hash_memo = {}
+
+    # rendered figure bytes by KQL.figure_key, shared by every agency rendered in this process
+    figure_memo = {}
+
+    def __init__(
+        self,
+        path: Union[Path, AnyPath],
+        template: str = "",
+        subfolder: str = "notebooks",
+        timespan: str = "P30D",
+        cache_ttl: int = 0,
+        cache_size: int = 2 * 1024**3,
+        time_slices: int = 0,
+        history: str = "",
+    ):
         """
         Convenience tooling for loading pandas dataframes using context from a path.
         path is expected to be pathlib type object with a structure like below:
@@ -178,28 +289,60 @@ class KQL:
            |  |--*/*.kql
            |--lists
            |  |--SentinelWorkspaces.csv
-           |  `--SecOps Groups.csv
+           |  |--SecOps Groups.csv
+           |  `--WorkspaceRegistry.csv (discovered workspaces, used if SentinelWorkspaces.csv is missing)
            |--markdown
            |  `--**.md
-           `--reports
-              `--*/*/*.pdf
+           |--reports
+           |  `--*/*/*.pdf
+           |--cache
+           |  |--*.parquet
+           |  `--figures/*.png
+           `--history
+              `--*/*/*.parquet
+        If cache_ttl is set (seconds), query results are kept under cache for reuse by later runs.
+        Rendered figures are always kept under cache/figures, expiring after cache_ttl (or a day) within cache_size bytes.
+        If time_slices is set, queries with a `// split:` header are run over that many sub windows of timespan in parallel.
+        If history is set (an ISO 8601 retention, e.g. P365D), queries with a `// history:` header are refreshed incrementally into history.
+        The workspace lists are read on first access (wsdf, ws_lookups, sentinelworkspaces), so construction does no io.
         """
         self.pdf_css_file = False
         self.timespan, self.path, self.nbpath = timespan, path, path / sanitize_filepath(subfolder)
+        self.time_slices = time_slices
+        self.history_store = HistoryStore(self.nbpath / "history", retention=history) if history else None
         self.kql, self.lists, self.reports = self.nbpath / "kql", self.nbpath / "lists", self.nbpath / "reports"
-        if (self.lists / "SentinelWorkspaces.csv").exists():
-            self.wsdf = pandas.read_csv((self.lists / "SentinelWorkspaces.csv").open()).join(
-                pandas.read_csv((self.lists / "SecOps Groups.csv").open()).set_index("Alias"),
-                on="SecOps Group",
-            )
-            self.ws_lookups = self.wsdf[["customerId", "Primary agency", "SecOps Group"]].set_index("customerId").to_dict()
-            self.sentinelworkspaces = list(self.wsdf.customerId.dropna())
-        else:
-            self.sentinelworkspaces = KQL.list_workspaces()
+        self.cache_ttl, self.cache_size = cache_ttl, cache_size
+        self.result_cache = ResultCache(self.nbpath / "cache", ttl=cache_ttl, maxsize=cache_size) if cache_ttl else None
+        self.figure_caches = {}
         self.today = pandas.Timestamp("today")
+        if hasattr(path, "client"):
+            # cloudpathlib unpickles paths with its default client, so render_fleet workers (forked after this) get this report's
+            path.client.set_as_default_client()
         if template:
             self.load_templates(mdpath=template)
-        azcli(["extension", "add", "-n", "log-analytics", "-y"])
+
+    @cached_property
+    def wsdf(self) -> pandas.DataFrame:
+        "SentinelWorkspaces.csv joined to SecOps Groups.csv"
+        return pandas.read_csv((self.lists / "SentinelWorkspaces.csv").open()).join(
+            pandas.read_csv((self.lists / "SecOps Groups.csv").open()).set_index("Alias"),
+            on="SecOps Group",
+        )
+
+    @cached_property
+    def ws_lookups(self) -> dict:
+        return self.wsdf[["customerId", "Primary agency", "SecOps Group"]].set_index("customerId").to_dict()
+
+    @cached_property
+    def sentinelworkspaces(self) -> list[str]:
+        "Workspaces to query (set_agency narrows this to one agency's)"
+        if (self.lists / "SentinelWorkspaces.csv").exists():
+            return list(self.wsdf.customerId.dropna())
+        elif (self.lists / "WorkspaceRegistry.csv").exists():
+            # refresh with KQL.list_workspaces(kp.lists / "WorkspaceRegistry.csv")
+            return KQL.registry_workspaces(KQL.read_registry(self.lists / "WorkspaceRegistry.csv"))
+        else:
+            return KQL.list_workspaces(self.lists / "WorkspaceRegistry.csv")
 
     def set_agency(self, agency: str, sample_agency: str = "", sample_only: bool = False):
         # if sample_only = True, build report with only mock data
@@ -221,35 +364,282 @@ class KQL:
         """
         load a bunch of kql into dataframes
         """
-        querystats = {}
+        for _ in self.iter_queries(queries):
+            pass
+
+    def iter_queries(self, queries: dict({str: str})):
+        """
+        Streaming version of load_queries, yielding (section, kql, dataframe, stats) in completion order.
+        A section's sample agency fallback is submitted as soon as its own query comes back with no data,
+        and the section is yielded once the fallback lands. self.queries and self.querystats are set when exhausted.
+        Identical queries and query bundles are submitted once (see submit_queries).
+        Starts a new telemetry run, so querystats and the Telemetry sheet only count this run's requests.
+        """
+        self.run = loganalytics.telemetry().start_run()
+        print(f"Running {len(queries.keys())} queries across {self.agency_name}: {len(self.sentinelworkspaces)} workspaces (sample: {self.sample_agency}): ")
+        results, samples, pending, fallbacks = {}, {}, {}, {}
         with ThreadPoolExecutor() as executor:
-            print(
-                f"Running {len(queries.keys())} queries across {self.agency_name}: {len(self.sentinelworkspaces)} workspaces (sample: {self.sample_agency}): "
+            if self.sample_only:
+                # force return no results to fallback to sample data
+                futures = {key: Future() for key in queries}
+                for key, f in futures.items():
+                    f.set_result(KQL.no_data_df(self.read_kql(queries[key]), self.timespan))
+            else:
+                futures = self.submit_queries(executor, queries)
+            for key, f in futures.items():
+                pending.setdefault(f, []).append((key, False))
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    for key, sample in pending.pop(f):
+                        kql, df = queries[key], f.result()
+                        if sample:
+                            samples[key] = df
+                            yield key, kql, df, KQL.query_stats(results[key], kql)
+                        else:
+                            results[key] = df
+                            if KQL.no_data(df) and self.sampleworkspaces:
+                                identity = KQL.query_identity(self.read_kql(kql))
+                                if identity not in fallbacks:
+                                    fallbacks[identity] = executor.submit(self.kql2df, kql, workspaces=self.sampleworkspaces)
+                                    pending[fallbacks[identity]] = []
+                                pending[fallbacks[identity]].append((key, True))
+                            else:
+                                yield key, kql, df, KQL.query_stats(df, kql)
+        self.collect_queries(queries, {key: results[key] for key in queries}, samples)
+
+    def submit_queries(self, executor: ThreadPoolExecutor, queries: dict({str: str}), workspaces: list[str] = []) -> dict({str: Future}):
+        """
+        Submit kql2df for each section's query to executor, returning {section: future}.
+        Identical queries (ignoring indentation and blank lines) are run once, even under different section names,
+        and those sections share the future and its dataframe. Queries with the same `// bundle: name` header
+        run together as one query bundle (see bundle2df), unless they read history or are time sliced.
+        """
+        identities = {key: KQL.query_identity(self.read_kql(kql)) for key, kql in queries.items()}
+        distinct = {}
+        for key, identity in identities.items():
+            distinct.setdefault(identity, queries[key])
+        bundles = {}
+        for identity, kql in distinct.items():
+            query = self.read_kql(kql)
+            options = KQL.query_options(query)
+            if not options.get("bundle") or (self.history_store and "history" in options) or (self.time_slices > 1 and "split" in options):
+                continue
+            if KQL.source_table(query) != "let":  # let statements would clash between bundled queries
+                bundles.setdefault(options["bundle"], []).append(identity)
+        # backends that can't return multiple result tables (azcli) run bundled queries one by one
+        bundles = [members for members in bundles.values() if len(members) > 1] if KQL.bundle_backend() else []
+        bundled = {identity for members in bundles for identity in members}
+        futures = {identity: executor.submit(self.kql2df, kql, workspaces=workspaces) for identity, kql in distinct.items() if identity not in bundled}
+        for members in bundles:
+            bundle = executor.submit(self.bundle2df, [distinct[identity] for identity in members], workspaces=workspaces)
+            for i, identity in enumerate(members):
+                futures[identity] = Future()
+                bundle.add_done_callback(partial(KQL.bundle_part, futures[identity], i))
+        for key, identity in identities.items():
+            if queries[key] != distinct[identity]:
+                futures[identity].add_done_callback(partial(self.record_duplicate, queries[key], workspaces))
+        return {key: futures[identity] for key, identity in identities.items()}
+
+    def record_duplicate(self, kql: str, workspaces: list[str], future: Future):
+        "Record a query answered by an identical query's result in telemetry (source duplicate), for its section's querystats"
+        if future.exception():
+            return
+        query, df = self.read_kql(kql), future.result()
+        loganalytics.telemetry().label(query, kql)
+        rows = 0 if KQL.no_data(df) else len(df)
+        loganalytics.telemetry().record("query", query, workspaces or self.sentinelworkspaces, wall=0.0, rows=rows, source="duplicate")
+
+    def bundle_part(part: Future, i: int, bundle: Future):
+        "Resolve part with the i'th dataframe of a finished bundle2df future"
+        if bundle.exception():
+            part.set_exception(bundle.exception())
+        else:
+            part.set_result(bundle.result()[i])
+
+    def query_stats(df: pandas.DataFrame, kql: str) -> list:
+        "Rows, Columns and KQL for querystats, with the missing table and timespan in place of columns when there's no data"
+        if KQL.no_data(df):
+            return [0, f"{df.columns[0]} - {df.iloc[0,0]}", kql]
+        return [df.count().max(), len(df.columns), kql]
+
+    def collect_queries(self, queries: dict({str: str}), results: dict({str: pandas.DataFrame}), samples: dict({str: pandas.DataFrame}) = {}):
+        """
+        Set self.queries and self.querystats from query results, substituting samples for sections with no data
+        """
+        querystats = {}
+        for key, df in results.items():
+            kql = queries[key]
+            querystats[key] = KQL.query_stats(df, kql)
+            if KQL.no_data(df):
+                df = samples.get(key, df)
+            queries[key] = (kql, df)
+        self.queries = queries
+        self.querystats = pandas.DataFrame(querystats).T.rename(columns={0: "Rows", 1: "Columns", 2: "KQL"}).sort_values("Rows")
+        self.querystats = self.querystats.join(self.telemetry_stats(), on="KQL")
+
+    def telemetry(self) -> pandas.DataFrame:
+        """
+        loganalytics.telemetry() events for this report's workspaces, without other agencies' details (they end up in its excel export).
+        Chunk events shared with other workspaces (fleet queries) are cut down to this agency's workspaces and rows, with no bytes
+        or decode time, and query events spanning other workspaces (fleet wide and sample agency queries) are dropped.
+        Only the latest load_queries (or load_queries_fleet) run's events are included, if there has been one.
+        """
+        df = loganalytics.telemetry().frame(getattr(self, "run", None))
+        if df.empty:
+            return df
+        mine = set(self.sentinelworkspaces)
+        df = df[df["workspaces"].map(lambda workspaces: not mine.isdisjoint(workspaces))]
+        shared = ~df["workspaces"].map(mine.issuperset)
+        df = df[~(shared & (df["stage"] == "query"))].copy()
+        shared = shared[df.index]
+        df["workspaces"] = df["workspaces"].map(lambda workspaces: [w for w in workspaces if w in mine])
+        if "workspace_rows" in df.columns:
+            df["workspace_rows"] = df["workspace_rows"].map(lambda rows: {w: n for w, n in rows.items() if w in mine} if isinstance(rows, dict) else rows)
+            df["rows"] = df["rows"].mask(shared, df["workspace_rows"].map(lambda rows: sum(rows.values()) if isinstance(rows, dict) else 0))
+            for column in ("bytes", "decode"):
+                df[column] = df[column].mask(shared)
+        return df.reset_index(drop=True)
+
+    def telemetry_stats(self) -> pandas.DataFrame:
+        "Seconds, Source, Requests, Retries, Errors, Bytes and Decode (seconds) per KQL from telemetry, for querystats"
+        columns, parts = ["Seconds", "Source", "Requests", "Retries", "Errors", "Bytes", "Decode"], []
+        df = self.telemetry()
+        queries, chunks = (df[df["stage"] == stage] if len(df) else df for stage in ("query", "chunk"))
+        if len(queries):
+            parts.append(queries.groupby("name").agg(Seconds=("wall", "sum"), Source=("source", "last")))
+        if len(chunks):
+            errors = lambda kinds: ", ".join(sorted(set(kinds) - {""}))
+            parts.append(
+                chunks.groupby("name").agg(
+                    Requests=("attempt", "size"),
+                    Retries=("attempt", lambda a: (a > 0).sum()),
+                    Errors=("error", errors),
+                    Bytes=("bytes", "sum"),
+                    Decode=("decode", "sum"),
+                )
             )
-            for key, kql in queries.items():
-                if self.sample_only:
-                    # force return no results to fallback to sample data
-                    query = (self.kql / kql).open().read()
-                    table = query.split("\n")[0].split(" ")[0].strip()
-                    df = pandas.DataFrame([{f"{table}": f"No Data in timespan {self.timespan}"}])
-                    queries[key] = (kql, df)
-                    querystats[key] = [0, f"{df.columns[0]} - {df.iloc[0,0]}", kql]
-                else:
-                    queries[key] = (kql, executor.submit(self.kql2df, kql))
-            wait([f for kql, f in queries.values() if isinstance(f, Future)])
-            queries.update({key: (f[0], f[1].result()) for key, f in queries.items() if isinstance(f[1], Future)})
-            for key, df in queries.items():
-                kql, df = df
-                if df.shape == (1, 1) and df.iloc[0, 0].startswith("No Data"):
-                    querystats[key] = [0, f"{df.columns[0]} - {df.iloc[0,0]}", kql]
-                    if self.sampleworkspaces:
-                        queries[key] = (kql, executor.submit(self.kql2df, kql, workspaces=self.sampleworkspaces))
+        return pandas.concat(parts, axis=1).reindex(columns=columns) if parts else pandas.DataFrame(columns=columns)
+
+    def load_queries_fleet(self, queries: dict({str: str}), agencies: list[str] = [], sample_agency: str = "", sample_only: bool = False) -> dict:
+        """
+        Run each query once for every agency, then split the results per agency in memory.
+        Queries with a `// fleet: TenantId` header return TenantId on every row, so are run once across all workspaces
+        in 20 workspace chunks and split using ws_lookups. Other queries are run per agency on one shared executor.
+        Identical queries and query bundles are run once, as in iter_queries (see submit_queries).
+        Sample data comes from the sample agency's split results, so fallbacks cost no extra queries.
+        With sample_only, only the sample agency's workspaces are queried.
+        Returns {agency: KQL} ready for init_report / report_pdf, sharing a new telemetry run as in iter_queries.
+        """
+        self.run = loganalytics.telemetry().start_run()
+        agencies = list(agencies) or list(self.wsdf["SecOps Group"].dropna().unique())
+        groups = {}
+        for agency in agencies + ([sample_agency] if sample_agency else []):
+            workspaces = list(self.wsdf[self.wsdf["SecOps Group"] == agency].customerId.dropna())
+            if workspaces:
+                groups[agency] = workspaces
+        # sample_only reports show no data of their own, so only the sample agency's results are needed
+        queried = {agency: workspaces for agency, workspaces in groups.items() if not sample_only or agency == sample_agency}
+        fleet = sorted(set(sum(queried.values(), [])))
+        print(f"Running {len(queries.keys())} queries across {len(queried)} agencies: {len(fleet)} workspaces (sample: {sample_agency}): ")
+        with ThreadPoolExecutor() as executor:
+            fleet_queries = {key: kql for key, kql in queries.items() if KQL.query_options(self.read_kql(kql)).get("fleet") == "TenantId"}
+            agency_queries = {key: kql for key, kql in queries.items() if key not in fleet_queries}
+            futures = self.submit_queries(executor, fleet_queries, workspaces=fleet) if fleet else {}
+            by_agency = {agency: self.submit_queries(executor, agency_queries, workspaces=workspaces) for agency, workspaces in queried.items()}
+            for key in agency_queries:
+                futures[key] = {agency: by_agency[agency][key] for agency in queried}
+            results = {agency: {} for agency in queried}
+            for key, f in futures.items():
+                if isinstance(f, dict):
+                    for agency, af in f.items():
+                        results[agency][key] = af.result()
                 else:
-                    querystats[key] = [df.count().max(), len(df.columns), kql]
-            wait([f for kql, f in queries.values() if isinstance(f, Future)])
-            queries.update({key: (f[0], f[1].result()) for key, f in queries.items() if isinstance(f[1], Future)})
-            self.queries = queries
-        self.querystats = pandas.DataFrame(querystats).T.rename(columns={0: "Rows", 1: "Columns", 2: "KQL"}).sort_values("Rows")
+                    for agency, df in self.split_by_agency(f.result(), self.read_kql(queries[key])).items():
+                        if agency in results:
+                            results[agency][key] = df
+        reports = {}
+        for agency in agencies:
+            if agency not in groups:
+                print(f"{agency} has no workspaces, skipping")
+                continue
+            kp = copy.copy(self).set_agency(agency, sample_agency=sample_agency, sample_only=sample_only)
+            if sample_only:
+                agency_results = {key: KQL.no_data_df(self.read_kql(kql), self.timespan) for key, kql in queries.items()}
+            else:
+                agency_results = results[agency]
+            kp.collect_queries(dict(queries), agency_results, results.get(sample_agency, {}))
+            reports[agency] = kp
+        return reports
+
+    def split_by_agency(self, df: pandas.DataFrame, query: str) -> dict({str: pandas.DataFrame}):
+        "Split a fleet wide result on its TenantId column into per agency results"
+        if KQL.no_data(df):
+            return {agency: df for agency in self.wsdf["SecOps Group"].dropna().unique()}
+        owners = df["TenantId"].map(self.ws_lookups["SecOps Group"])
+        # renumbered, as a split of the fleet's index would show up as an extra index column in excel exports
+        split = {agency: part.reset_index(drop=True) for agency, part in df.groupby(owners, sort=False)}
+        for agency in self.wsdf["SecOps Group"].dropna().unique():
+            if agency not in split:
+                split[agency] = KQL.no_data_df(query, self.timespan)
+        return split
+
+    def render_fleet(reports: dict, render, max_workers: int = None, store: SharedStore = None) -> dict:
+        """
+        Call render(kp) for each agency's KQL in a process pool, e.g. to build esparto pages and run report_pdf.
+        render must be picklable (a module or notebook level function). Returns {agency: result or exception}.
+        With a SharedStore, query results and the workspace table are published once and memory mapped by the workers,
+        rather than pickled into each (sample agency results are otherwise copied once per agency).
+        """
+        outputs = {}
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for agency, kp in reports.items():
+                if store is None:
+                    futures[agency] = executor.submit(render, kp)
+                    continue
+                name = kp.publish_queries(store, agency)
+                shared = copy.copy(kp)
+                published = {key for key, (kql, frame) in store.read_manifest(name)["queries"].items() if frame}
+                shared.queries = {key: query for key, query in kp.queries.items() if key not in published}
+                for attribute in ("wsdf", "ws_lookups"):
+                    shared.__dict__.pop(attribute, None)
+                futures[agency] = executor.submit(KQL.render_shared, render, shared, store, name)
+            for agency, f in futures.items():
+                try:
+                    outputs[agency] = f.result()
+                except Exception as e:
+                    print(f"{agency} failed: {e}")
+                    outputs[agency] = e
+        return outputs
+
+    def render_shared(render, kp: KQL, store: SharedStore, name: str):
+        return render(kp.attach_queries(store, name))
+
+    def publish_queries(self, store: SharedStore, name: str = "") -> str:
+        """
+        Publish query results (and the workspace table, if loaded) to a SharedStore under a manifest name (default: agency),
+        for render_fleet workers or sibling papermill notebooks to attach_queries. Dataframes shared between agencies
+        (like sample agency fallbacks) are written once. Results arrow can't represent are recorded without a frame.
+        """
+        name = name or self.agency
+        manifest = {"queries": {}, "workspaces": store.publish(self.wsdf, "workspaces") if "wsdf" in self.__dict__ else None}
+        for key, (kql, df) in self.queries.items():
+            manifest["queries"][key] = [kql, store.publish(df)]
+        manifest["querystats"] = json.loads(self.querystats.to_json(orient="split"))
+        store.write_manifest(name, manifest)
+        return name
+
+    def attach_queries(self, store: SharedStore, name: str = "") -> KQL:
+        "Load queries, querystats and the workspace table published by publish_queries, memory mapped read only"
+        manifest = store.read_manifest(name or self.agency)
+        if manifest["workspaces"] and "wsdf" not in self.__dict__:
+            self.wsdf = store.attach(manifest["workspaces"])
+        queries = getattr(self, "queries", {})
+        self.queries = {key: (kql, store.attach(frame)) if frame else queries[key] for key, (kql, frame) in manifest["queries"].items()}
+        if not hasattr(self, "querystats"):
+            self.querystats = pandas.DataFrame(**manifest["querystats"])
+        return self
 
     def load_templates(self, mdpath: str):
         """
@@ -268,13 +658,16 @@ class KQL:
         if len(self.sentinelworkspaces) == 0:
             raise Exception("No workspaces to query, report generation failed.")
         # Return an esparto page for reporting after customising css and style seaborn / matplotlib
-        self.sns.set_theme(
+        import esparto, tinycss2
+
+        self.theme = dict(
             style="darkgrid",
             context="paper",
             font=font,
             font_scale=0.7,
             rc={"figure.figsize": (7, 3), "figure.constrained_layout.use": True, "legend.loc": "upper right"},
         )
+        self.sns.set_theme(**self.theme)
         pandas.set_option("display.max_colwidth", None)
         kwargs["font"] = ", ".join([f'"{f}"' for f in font])
         self.css_params = kwargs
@@ -298,19 +691,70 @@ class KQL:
         esparto.options.esparto_css = self.pdf_css_file.name
         return self.report
 
-    def report_pdf(self, preview=True, folders=True, savehtml=False):
+    def figure_key(df: pandas.DataFrame, plot: dict, format: str, dpi: int, theme: dict) -> str:
+        "sha256 of the dataframe's contents, index and columns, and the plot parameters"
+        digest = hashlib.sha256(pickle.dumps((list(df.columns), plot, format, dpi, theme)))
+        try:
+            digest.update(pandas.util.hash_pandas_object(df, index=True).values.tobytes())
+        except TypeError:
+            # unhashable cells (e.g. lists from dynamic columns)
+            digest.update(pickle.dumps(df))
+        return digest.hexdigest()
+
+    def figures(self, specs: dict, format: str = "png", dpi: int = 150, pool: rendering.RenderPool = None) -> dict:
+        """
+        Render {name: (df, plot kwargs)} as df.plot(**kwargs) figures in a process pool (default: rendering.pool()),
+        returning {name: esparto content} to add to report sections, e.g.
+            figs = kp.figures({"signins": (df, {"kind": "barh", "title": "Sign in types"})})
+            rp[section] += figs["signins"]
+        Figure bytes are cached by KQL.figure_key in process and under cache/figures, so identical charts
+        (such as sample agency sections) are only rasterised once across a fleet run. Call after init_report to use its theme.
+        """
+        import esparto
+
+        theme = getattr(self, "theme", None)
+        figure_cache = self.figure_cache(format)
+        keys = {name: KQL.figure_key(df, plot, format, dpi, theme) for name, (df, plot) in specs.items()}
+        pending = {}
+        for name, (df, plot) in specs.items():
+            key = keys[name]
+            if key in KQL.figure_memo or key in pending.values():
+                continue
+            content = figure_cache.get_bytes(key)
+            if content is not None:
+                KQL.figure_memo[key] = content
+            else:
+                pool = pool or rendering.pool()
+                pending[pool.submit(rendering.render_figure, df, plot, format, dpi, theme)] = key
+        for future, key in pending.items():
+            KQL.figure_memo[key] = future.result()
+            figure_cache.set_bytes(key, KQL.figure_memo[key])
+        if format == "svg":
+            return {name: esparto.RawHTML(KQL.figure_memo[key].decode("utf8")) for name, key in keys.items()}
+        return {name: esparto.Image(io.BytesIO(KQL.figure_memo[key])) for name, key in keys.items()}
+
+    def figure_cache(self, format: str) -> ResultCache:
+        "cache/figures, expiring and evicted like the result cache (a day if that's disabled) so it doesn't grow without bound"
+        if format not in self.figure_caches:
+            # kept, so its size is tracked across figures calls rather than listing the folder for each
+            self.figure_caches[format] = ResultCache(
+                self.nbpath / "cache" / "figures", ttl=self.cache_ttl or 86400, maxsize=self.cache_size, suffix=f".{format}"
+            )
+        return self.figure_caches[format]
+
+    def report_files(self, folders=True):
+        "Set pdf_file and excel_file paths for the current agency, creating the report folder"
         if folders:
             report_dir = self.reports / self.agency
         else:
             report_dir = self.reports
         report_dir.mkdir(parents=True, exist_ok=True)
-
         self.pdf_file = report_dir / f"{self.report_title.replace(' ','')}-{self.agency}-{self.today.strftime('%b%Y')}.pdf"
-        self.html = self.report.save_pdf(self.pdf_file, return_html=True)
-        if savehtml:
-            self.pdf_file.with_suffix(".html").open("w+t").write(self.html)
-
         self.excel_file = report_dir / f"{self.report_title.replace(' ','')}-{self.agency}-{self.today.strftime('%b%Y')}.xlsx"
+        return self.pdf_file, self.excel_file
+
+    def excel_sheets(self) -> dict({str: pandas.DataFrame}):
+        "Query stats, each query's results (or its stats row if it had no data) and query telemetry for the excel export"
         dfs = {}
         dfs["Query Stats"] = self.querystats
         for name, data in self.queries.items():
@@ -318,120 +762,524 @@ class KQL:
                 dfs[name] = pandas.DataFrame([self.querystats.loc[name]])
             else:
                 dfs[name] = data[1]
-        with pandas.ExcelWriter(self.excel_file) as writer:
-            for name, df in dfs.items():
-                date_columns = df.select_dtypes(include=["datetimetz"]).columns
-                for date_column in date_columns:
-                    df[date_column] = df[date_column].dt.tz_localize(None)
-                df = df.drop("TableName", axis=1, errors="ignore")
-                df.to_excel(writer, sheet_name=name)
+        telemetry = self.telemetry()
+        if not telemetry.empty:
+            dfs["Telemetry"] = telemetry
+        return dfs
+
+    def staged_files(self, uploader: uploads.Uploader = None):
+        """
+        Local files to write the report to: pdf_file and excel_file themselves, or for blob reports (or if an uploader is given)
+        the same names in an uploader buffer folder. Returns uploader, buffer (None if not staged), pdf and excel paths.
+        """
+        if uploader is None and isinstance(self.pdf_file, Path):
+            return None, None, self.pdf_file, self.excel_file
+        uploader = uploader or uploads.uploader()
+        buffer = uploader.stage(self.pdf_file.parent)
+        return uploader, buffer, buffer / self.pdf_file.name, buffer / self.excel_file.name
+
+    def report_pdf(self, preview=True, folders=True, savehtml=False, uploader: uploads.Uploader = None, **excel):
+        """
+        Save the pdf (and html), and export query results with rendering.write_excel(**excel), e.g. max_rows=10000, bulk='parquet'.
+        Blob reports are written locally then uploaded by uploader (default: uploads.uploader()), with per file throughput in self.uploads.
+        """
+        self.report_files(folders)
+        uploader, buffer, pdf_file, excel_file = self.staged_files(uploader)
+        excel.setdefault("created", self.today)  # fixed metadata, so unchanged reports are skipped by uploads
+        self.html = rendering.render_pdf(self.report, pdf_file, self.pdf_css_file.name, created=self.today)
+        if savehtml:
+            pdf_file.with_suffix(".html").open("w+t").write(self.html)
+        rendering.write_excel(self.excel_sheets(), excel_file, **excel)
+        if buffer:
+            self.uploads = uploader.upload(buffer)
         if preview:
+            from IPython import display
+
             return display.IFrame(self.pdf_file, width=1200, height=800)
         else:
             return self.pdf_file
 
-    def list_workspaces() -> list[str]:
-        "Get sentinel workspaces as a list of named tuples"
-        azcli(["extension", "add", "-n", "resource-graph", "-y"])
-        workspaces = azcli(
-            [
-                "graph",
-                "query",
-                "-q",
-                KQL.graph_workspaces_kql,
-                "--first",
-                "1000",
-                "--query",
-                "data[]",
-            ]
+    def report_pdf_async(
+        self, folders=True, savehtml=False, pool: rendering.RenderPool = None, uploader: uploads.Uploader = None, **excel
+    ) -> dict({str: Future}):
+        """
+        Submit pdf layout, html save and excel export as independent jobs to a process pool (default: rendering.pool()).
+        Returns {"pdf": future, "html": future, "xlsx": future}, the pdf future resolving to the rendered html.
+        Pass a RenderPool(max_workers, max_pending) to bound concurrency and memory, and excel kwargs as for report_pdf.
+        Blob reports (or any, if an uploader is given) also get an "upload" future, resolving to per file upload throughput once the jobs are done.
+        """
+        pool = pool or rendering.pool()
+        self.report_files(folders)
+        uploader, buffer, pdf_file, excel_file = self.staged_files(uploader)
+        css_file = self.pdf_css_file.name
+        excel.setdefault("created", self.today)
+        futures = {"pdf": pool.submit(rendering.render_pdf, self.report, pdf_file, css_file, created=self.today)}
+        if savehtml:
+            futures["html"] = pool.submit(rendering.render_html, self.report, pdf_file.with_suffix(".html"), css_file)
+        futures["xlsx"] = pool.submit(rendering.write_excel, self.excel_sheets(), excel_file, **excel)
+        if buffer:
+            futures["upload"] = uploader.submit(buffer, list(futures.values()))
+        return futures
+
+    def list_workspaces(registry: Union[Path, AnyPath, None] = None) -> list[str]:
+        "Get sentinel workspace ids, refreshing the workspace registry (if given) for new or stale workspaces"
+        return KQL.registry_workspaces(KQL.update_registry(registry))
+
+    def discover_workspaces() -> list[dict]:
+        "All workspaces with security solutions installed, following resource graph skip tokens past the 1000 row page size"
+        azcli_extension("resource-graph")
+        workspaces, skip_token = [], ""
+        while True:
+            cmd = ["graph", "query", "-q", KQL.graph_workspaces_kql, "--first", "1000"]
+            if skip_token:
+                cmd += ["--skip-token", skip_token]
+            page = azcli(cmd)
+            if not page:
+                break
+            workspaces += page.get("data", [])
+            skip_token = page.get("skip_token")
+            if not skip_token:
+                break
+        return workspaces
+
+    def update_registry(registry: Union[Path, AnyPath, None] = None, stale: str = "P7D") -> pandas.DataFrame:
+        """
+        Discover workspaces and record when each last raised a SecurityAlert.
+        Only workspaces that are new, or were last validated more than stale ago, are re-validated,
+        so later runs skip the slow cross workspace alerts query. The registry is saved as csv if a path is given.
+        If the alerts query fails for any chunk, nothing is marked validated, so every pending workspace is retried next run.
+        """
+        now = pandas.Timestamp.utcnow()
+        known = (
+            KQL.read_registry(registry) if registry is not None and registry.exists() else pandas.DataFrame(columns=["customerId", "LastAlert", "Validated"])
         )
-        if not workspaces:
+        discovered = pandas.DataFrame(KQL.discover_workspaces())
+        if discovered.empty:
+            return known
+        df = discovered.merge(known[["customerId", "LastAlert", "Validated"]], on="customerId", how="left")
+        df["LastAlert"], df["Validated"] = pandas.to_datetime(df["LastAlert"], utc=True), pandas.to_datetime(df["Validated"], utc=True)
+        todo = df["Validated"].isna() | (df["Validated"] < now - pandas.Timedelta(stale))
+        if todo.any():
+            # strict, as a failed chunk's workspaces would otherwise look validated with no alerts and drop out until stale
+            try:
+                alerts = KQL.analytics_query(workspaces=list(df[todo]["customerId"]), query=KQL.workspace_alerts_kql, timespan=KQL.alerts_lookback, strict=True)
+            except loganalytics.QueryError as e:
+                print(f"Workspace validation failed, retrying {todo.sum()} workspaces next run: {e}")
+            else:
+                if not KQL.no_data(alerts):
+                    last = pandas.to_datetime(alerts.groupby("TenantId")["LastAlert"].max(), utc=True)
+                    refreshed = df["customerId"].map(last)
+                    df["LastAlert"] = refreshed.where(todo & refreshed.notna(), df["LastAlert"])
+                df.loc[todo, "Validated"] = now
+        if registry is not None:
+            with registry.open("w") as f:
+                df.to_csv(f, index=False)
+        return df
+
+    def read_registry(registry: Union[Path, AnyPath]) -> pandas.DataFrame:
+        with registry.open() as f:
+            df = pandas.read_csv(f)
+        df["LastAlert"], df["Validated"] = pandas.to_datetime(df["LastAlert"], utc=True), pandas.to_datetime(df["Validated"], utc=True)
+        return df
+
+    def registry_workspaces(df: pandas.DataFrame) -> list[str]:
+        "Workspace ids that have raised a SecurityAlert within alerts_lookback"
+        if df.empty:
             return []
-        # subscriptions is filtered to just those with security solutions installed
-        sentinelworkspaces = list()
-        # TODO: page on skiptoken if total workspaces exceeds 1000
-        # cross check workspaces to make sure they have SecurityIncident tables
-        validated = set(KQL.analytics_query(workspaces=[ws["customerId"] for ws in workspaces], query=KQL.distinct_tenantids, timespan="P7D")["TenantId"])
-        for ws in workspaces:
-            if ws["customerId"] in validated:
-                sentinelworkspaces.append(ws["customerId"])
-        return sentinelworkspaces
-
-    def kql2df(self, kql: str, timespan: str = "", workspaces: list[str] = []):
+        recent = df["LastAlert"] >= pandas.Timestamp.utcnow() - pandas.Timedelta(KQL.alerts_lookback)
+        return list(df[recent]["customerId"])
+
+    def kql2df(self, kql: str, timespan: str = "", workspaces: list[str] = [], stages: list[str] = []):
         # Load or directly query kql against workspaces
         # Parse results as json and return as a dataframe
+        # stages (e.g. KQL.label_size_kql(...)) are appended to the query so aggregation happens in kusto,
+        # and bypass history and time slicing, as stored or partial results can't be re-aggregated
+        # Each call is recorded in loganalytics.telemetry() with its source (history, cache, sliced or query)
+        start, name = time.perf_counter(), kql
         if not workspaces:
             workspaces = self.sentinelworkspaces
-        if kql.endswith(".kql") and (self.kql / sanitize_filepath(kql)).exists():
-            kql = (self.kql / sanitize_filepath(kql)).open().read()
-        df = KQL.analytics_query(workspaces=workspaces, query=kql, timespan=timespan or self.timespan)
-        df = df[df.columns].apply(pandas.to_numeric, errors="ignore")
+        kql = self.read_kql(kql)
+        if stages:
+            kql = kql.rstrip().rstrip(";") + "".join(stages)
+        timespan = timespan or self.timespan
+        loganalytics.telemetry().label(kql, name)
+        key = ResultCache.key(kql, workspaces, timespan) if self.result_cache else None
+        split = KQL.query_options(kql).get("split") if not stages else None
+        if self.history_store and "history" in KQL.query_options(kql) and not stages:
+            df, source = self.history(kql, workspaces, since=timespan), "history"
+        elif key and (df := self.result_cache.get(key)) is not None:
+            source = "cache"
+        else:
+            if self.time_slices > 1 and split:
+                df, source = self.sliced_query(workspaces, kql, timespan, split), "sliced"
+            else:
+                df, source = KQL.analytics_query(workspaces=workspaces, query=kql, timespan=timespan), "query"
+            partial = df.attrs.get("partial")
+            df = KQL.tidy(df)
+            if key and not partial and not KQL.no_data(df):
+                # empty results aren't cached as they may be a failed query, nor results missing failed chunks
+                self.result_cache.set(key, df)
+        rows = 0 if KQL.no_data(df) else len(df)
+        loganalytics.telemetry().record("query", kql, workspaces, wall=time.perf_counter() - start, rows=rows, source=source)
+        return df
+
+    def bundle2df(self, kqls: list[str], timespan: str = "", workspaces: list[str] = []) -> list[pandas.DataFrame]:
+        """
+        Run several queries as one query bundle (see bundle_kql), a single request per workspace chunk with a result table
+        per query, returning a dataframe per query. Cached results are reused, and the rest are cached as kql2df would.
+        Each query is recorded in loganalytics.telemetry() with source cache or bundle.
+        """
+        start = time.perf_counter()
+        workspaces, timespan = workspaces or self.sentinelworkspaces, timespan or self.timespan
+        queries = [self.read_kql(kql) for kql in kqls]
+        keys = [ResultCache.key(query, workspaces, timespan) if self.result_cache else None for query in queries]
+        dfs = [self.result_cache.get(key) if key else None for key in keys]
+        todo = [i for i, df in enumerate(dfs) if df is None]
+        if todo:
+            bundle = KQL.bundle_kql([queries[i] for i in todo])
+            loganalytics.telemetry().label(bundle, " + ".join(kqls[i] for i in todo))
+            for i, df in zip(todo, KQL.analytics_bundle(workspaces, [queries[i] for i in todo], timespan)):
+                dfs[i] = KQL.tidy(df)
+                if keys[i] and not df.attrs.get("partial") and not KQL.no_data(dfs[i]):
+                    self.result_cache.set(keys[i], dfs[i])
+        for i, (kql, query, df) in enumerate(zip(kqls, queries, dfs)):
+            loganalytics.telemetry().label(query, kql)
+            rows = 0 if KQL.no_data(df) else len(df)
+            source = "bundle" if i in todo else "cache"
+            loganalytics.telemetry().record("query", query, workspaces, wall=time.perf_counter() - start, rows=rows, source=source)
+        return dfs
+
+    def tidy(df: pandas.DataFrame) -> pandas.DataFrame:
+        "Coerce text columns to numbers where possible, parse TimeGenerated and use nullable dtypes"
+        if df.attrs.get("typed"):
+            return df  # already typed from the kusto column types
+        text = df.select_dtypes(include=["object", "string"]).columns  # api results are already typed, only coerce text
+        df[text] = df[text].apply(pandas.to_numeric, errors="ignore")
         if "TimeGenerated" in df.columns:
             df["TimeGenerated"] = pandas.to_datetime(df["TimeGenerated"])
-        df = df.convert_dtypes()
+        return df.convert_dtypes()
+
+    def history(self, kql: str, workspaces: list[str] = [], since: str = "") -> pandas.DataFrame:
+        """
+        Refresh a query's stored history (only querying from each workspace's watermark to now),
+        then return the merged history, limited to since (an ISO 8601 duration ending now, or start/end interval) if given.
+        Queries need a `// history: TimeGenerated` header naming the time column to partition on, and must return TenantId.
+        """
+        workspaces = workspaces or self.sentinelworkspaces
+        kql = self.read_kql(kql)
+        column = KQL.query_options(kql).get("history") or "TimeGenerated"
+        # strict, so a failed chunk holds back the watermark rather than leaving a gap in the history
+        run = lambda group, window: KQL.drop_no_data(KQL.tidy(KQL.analytics_query(workspaces=group, query=kql, timespan=window, strict=True)))
+        now = pandas.Timestamp.utcnow()
+        start, end = KQL.timespan_bounds(since, now) if since else (None, None)
+        self.history_store.refresh(kql, workspaces, run, column=column, now=now)
+        df = self.history_store.load(kql, workspaces, since=start)
+        if df is not None and start is not None:
+            times = pandas.to_datetime(df[column], utc=True)
+            df = df[(times >= start) & (times <= end)]
+        if df is None or df.empty:
+            return KQL.no_data_df(kql, since or self.history_store.retention.isoformat())
+        return df.sort_values(column, ignore_index=True)
+
+    def timespan_bounds(timespan: str, now: pandas.Timestamp = None) -> tuple:
+        "UTC start and end of an ISO 8601 duration ending now (e.g. P30D) or an ISO 8601 start/end interval"
+        try:
+            if "/" in timespan:
+                start, end = (pandas.Timestamp(t) for t in timespan.split("/", 1))
+                return tuple(t.tz_localize("UTC") if t.tzinfo is None else t.tz_convert("UTC") for t in (start, end))
+            end = now or pandas.Timestamp.utcnow()
+            return end - pandas.Timedelta(timespan), end
+        except ValueError as e:
+            raise ValueError(f"timespan {timespan!r} should be an ISO 8601 duration (P30D) or start/end interval") from e
+
+    def drop_no_data(df: pandas.DataFrame) -> pandas.DataFrame:
+        "Empty dataframe in place of the No Data placeholder"
+        return pandas.DataFrame() if KQL.no_data(df) else df
+
+    def sliced_query(self, workspaces: list[str], kql: str, timespan: str, split: str) -> pandas.DataFrame:
+        "Run kql over time_slices sub windows of timespan concurrently, then merge the partial results"
+        windows = KQL.split_timespan(timespan, self.time_slices)
+        with ThreadPoolExecutor(max_workers=len(windows)) as executor:
+            parts = list(executor.map(lambda window: KQL.analytics_query(workspaces=workspaces, query=kql, timespan=window), windows))
+        partial = any(df.attrs.get("partial") for df in parts)
+        parts = [df for df in parts if not KQL.no_data(df)]
+        df = KQL.merge_slices(parts, split) if parts else KQL.no_data_df(kql, timespan)
+        df.attrs["partial"] = partial
+        return df
+
+    def split_timespan(timespan: str, slices: int, end: pandas.Timestamp = None) -> list[str]:
+        """
+        Split an ISO 8601 duration (e.g. P30D) ending now (or end), or an ISO 8601 start/end interval, into slices ISO 8601 intervals.
+        Inner boundaries are floored to the hour so hourly bins rarely straddle two windows.
+        """
+        start, end = KQL.timespan_bounds(timespan, end)
+        bounds = [start] + [(start + (end - start) * i / slices).floor("H") for i in range(1, slices)] + [end]
+        iso = lambda t: t.strftime("%Y-%m-%dT%H:%M:%SZ")
+        return [f"{iso(a)}/{iso(b)}" for a, b in zip(bounds, bounds[1:]) if b > a]
+
+    def merge_slices(parts: list[pandas.DataFrame], split: str) -> pandas.DataFrame:
+        """
+        Combine per window results based on a query's `// split:` header:
+        // split: concat - rows are independent (projections / filters), just concatenate
+        // split: sum Count, Other - rows with identical values in every other column are merged by summing these columns,
+                  then sorted descending by the first
+        // split: sum * - as above, summing every numeric column
+        """
+        df = pandas.concat(parts, ignore_index=True)
+        method, _, spec = split.partition(" ")
+        if method == "concat":
+            return df
+        if method != "sum":
+            raise ValueError(f"Unknown split method '{split}', expected concat or sum")
+        if spec.strip() == "*":
+            measures = list(df.select_dtypes(include="number").columns)
+        else:
+            measures = [c.strip() for c in spec.split(",") if c.strip()]
+        columns, keys = list(df.columns), [c for c in df.columns if c not in measures]
+        df[measures] = df[measures].fillna(0)
+        df = df.groupby(keys, dropna=False, sort=False)[measures].sum().reset_index()[columns]
+        if spec.strip() != "*":
+            df = df.sort_values(measures[0], ascending=False, ignore_index=True)
         return df
 
+    def read_kql(self, kql: str) -> str:
+        "Return the contents of kql if it names a .kql file under the kql folder, otherwise kql itself"
+        if kql.endswith(".kql") and (self.kql / sanitize_filepath(kql)).exists():
+            return (self.kql / sanitize_filepath(kql)).open().read()
+        return kql
+
+    def query_options(query: str) -> dict({str: str}):
+        """
+        Parse `// option: value` comment lines from the top of a query, e.g.
+        // fleet: TenantId
+        """
+        options = {}
+        for line in query.strip().splitlines():
+            line = line.strip()
+            if not line.startswith("//"):
+                break
+            option, sep, value = line[2:].partition(":")
+            if sep:
+                options[option.strip().lower()] = value.strip()
+        return options
+
+    def source_table(query: str) -> str:
+        "First word of the query, skipping any comment lines"
+        lines = [line.strip() for line in query.strip().splitlines()]
+        lines = [line for line in lines if line and not line.startswith("//")] or [""]
+        return lines[0].split(" ")[0].strip()
+
+    def query_identity(query: str) -> str:
+        "Query text ignoring indentation and blank lines, to spot identical queries"
+        return "\n".join(line.strip() for line in query.strip().splitlines() if line.strip())
+
+    def bundle_kql(queries: list[str]) -> str:
+        """
+        Several queries as one kusto batch, a tabular statement per query so each returns its own result table.
+        If they all read the same source table it is scanned once with materialize. Materialize caches the whole source
+        table (every column, within the timespan) and fails past 5GB, so only bundle queries over small tables.
+        analytics_bundle splits chunks that go over the cap, and runs a single workspace's queries one by one as a last resort.
+        """
+        statements = [query.strip().rstrip(";") for query in queries]  # separators on their own line, as a query may end in a comment
+        sources = {KQL.source_table(query) for query in queries}
+        if len(sources) > 1:
+            return "\n;\n".join(statements)
+        source, shared = sources.pop(), []
+        for statement in statements:
+            lines = statement.splitlines()
+            first = next(n for n, line in enumerate(lines) if line.strip() and not line.strip().startswith("//"))
+            lines[first] = lines[first].replace(source, "_source", 1)
+            shared.append("\n".join(lines))
+        return f"let _source = materialize({source});\n" + "\n;\n".join(shared)
+
+    def no_data_df(query: str, timespan: str) -> pandas.DataFrame:
+        "Placeholder result for a query that returned nothing"
+        return pandas.DataFrame([{f"{KQL.source_table(query)}": f"No Data in timespan {timespan}"}])
+
+    def no_data(df: pandas.DataFrame) -> bool:
+        "True if df is the placeholder analytics_query returns when nothing came back"
+        return df.shape == (1, 1) and str(df.iloc[0, 0]).startswith("No Data")
+
     def rename_and_sort(self, df, names, rows=40, cols=40):
         # Rename columns based on dict
         df = df.rename(columns=names)
-        # Merge common columns
-        df = df.groupby(by=df.columns, axis=1).sum()
+        # Merge common columns, summing each set of duplicates by their factorized column codes
+        if df.columns.duplicated().any():
+            codes, columns = pandas.factorize(df.columns)
+            df = pandas.DataFrame({column: df.iloc[:, codes == code].sum(axis=1) for code, column in enumerate(columns)})
         # Sort columns by values, top 40
         df = df[df.sum(0).sort_values(ascending=False)[:cols].index]
-        # Sort rows by values, top 40
-        df = df.loc[df.sum(axis=1).sort_values(ascending=False)[:rows].index]
-        return df
+        # Sort rows by values, top 40 (by position, as index labels may repeat)
+        return df.iloc[df.sum(axis=1).reset_index(drop=True).sort_values(ascending=False)[:rows].index]
+
+    def rename_and_sort_kql(key: str, names: dict = {}, rows: int = 40, cols: int = 40) -> str:
+        """
+        rename_and_sort as a kql2df stage for a wide (pivoted) result with one row per key: columns are renamed (merging
+        by sum), then only the top cols columns, and the top rows rows by their total over those columns, are pivoted back.
+        Column and row order aren't preserved by pivot, so finish with kp.rename_and_sort(df.set_index(key), {}).
+        """
+        q = KQL.kql_name
+        return f"""
+        | evaluate narrow()
+        | as hint.materialized=true _narrow
+        | where Column != {KQL.kql_string(key)}
+        | lookup (_narrow | where Column == {KQL.kql_string(key)} | project Row, _key = Value) on Row
+        | extend Column = coalesce(tostring(dynamic({json.dumps(names)})[Column]), Column), Value = todouble(Value)
+        | summarize Value = sum(Value) by _key, Column
+        | as hint.materialized=true _cells
+        | join kind=inner (_cells | summarize _total = sum(Value) by Column | top {cols} by _total) on Column
+        | as hint.materialized=true _top
+        | join kind=inner (_top | summarize _total = sum(Value) by _key | top {rows} by _total) on _key
+        | evaluate pivot(Column, sum(Value), _key)
+        | project-rename {q(key)} = _key"""
+
+    def label_size_kql(category: str, metric: str, max_categories=9, quantile=0.5, max_scale=10, agg="sum", field="oversized", by: list[str] = []) -> str:
+        """
+        label_size as a kql2df stage: categories are sized and cut at the quantile (an approximate percentile in kusto),
+        then categories past max_categories in the normal and oversized groups are relabelled "N Others".
+        If by is given, rows are summarized to metric by category, field and by, so only aggregated rows are returned.
+        """
+        q = KQL.kql_name
+        # count is of non null values like pandas, kusto's count() takes no column
+        size = {"sum": "sum({})", "mean": "avg({})", "max": "max({})", "min": "min({})", "count": "countif(isnotempty({}))"}[agg].format(q(metric))
+        stage = f"""
+        | as hint.materialized=true _rows
+        | lookup kind=leftouter (
+            _rows
+            | summarize _size = {size} by {q(category)}
+            | as hint.materialized=true _sizes
+            | extend {q(field)} = _size > toscalar(_sizes | summarize percentile(_size, {quantile * 100:g})) * {max_scale}
+            | order by {q(field)} asc, _size desc
+            | extend _rank = row_number(1, prev({q(field)}) != {q(field)})
+            | as hint.materialized=true _ranked
+            | lookup (_ranked | summarize _others = countif(_rank > {max_categories}) by {q(field)}) on {q(field)}
+            | project {q(category)}, {q(field)}, _label = iff(_rank > {max_categories}, strcat(_others, " Others"), tostring({q(category)}))
+        ) on {q(category)}
+        | extend {q(category)} = _label
+        | project-away _label"""
+        if by:
+            stage += f"""
+        | summarize {q(metric)} = {size} by {", ".join(q(column) for column in [category, field] + by)}"""
+        return stage
+
+    def kql_name(name: str) -> str:
+        return f"[{KQL.kql_string(name)}]"
+
+    def kql_string(value: str) -> str:
+        return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
 
     def analytics_query(
         workspaces: list[str],
         query: str,
         timespan: str,
+        strict: bool = False,
     ):
-        "Queries a list of workspaces using kusto"
+        """
+        Queries a list of workspaces using kusto (with strict, raising a QueryError if any chunk failed rather than returning partial results).
+        Partial results are flagged with df.attrs["partial"], so they aren't cached.
+        """
+        chunks, errors = KQL.workspace_chunks(workspaces), []
+        backend = KQL.query_backend()
+        run = lambda chunk: backend(chunk, query, timespan)
+        print("." * len(chunks), end="")
+        results = loganalytics.scheduler().map(run, chunks, query, strict=strict, errors=errors)
+        print("!" * len(results), end="")
+        if results and all(isinstance(result, pa.Table) for result in results):
+            df = loganalytics.arrow2df(results)
+        elif results:
+            df = pandas.concat(results)
+        else:
+            df = KQL.no_data_df(query, timespan)
+        df.attrs["partial"] = bool(errors)
+        return df
+
+    def workspace_chunks(workspaces: list[str]) -> list[list[str]]:
         chunkSize = 20  # limit to 20 parallel workspaces at a time https://docs.microsoft.com/en-us/azure/azure-monitor/logs/cross-workspace-query#cross-resource-query-limits
         chunks = [
             workspaces[x : x + chunkSize] for x in range(0, len(workspaces), chunkSize)
         ]  # awesome list comprehension to break big list into chunks of chunkSize
         # chunks = [[1..10],[11..20]]
-        results, cmds = [], []
-        for chunk in chunks:
-            cmd = [
-                "monitor",
-                "log-analytics",
-                "query",
-                "--workspace",
-                chunk[0],
-                "--analytics-query",
-                query,
-                "--timespan",
-                timespan,
-            ]
-            if len(chunk) > 1:
-                cmd += ["--workspaces"] + chunk[1:]
-            cmds.append(cmd)
-            print(".", end="")
-        with ThreadPoolExecutor() as executor:
-            for result in executor.map(azcli, cmds, repeat(True)):
-                if not result.empty:
-                    results.append(result)
-                    print("!", end="")
-        if results:
-            return pandas.concat(results)
-        else:
-            table = query.split("\n")[0].split(" ")[0].strip()
-            return pandas.DataFrame([{f"{table}": f"No Data in timespan {timespan}"}])
+        return chunks
+
+    def analytics_bundle(workspaces: list[str], queries: list[str], timespan: str) -> list[pandas.DataFrame]:
+        "Queries a list of workspaces with a query bundle (bundle_kql), splitting each chunk's result tables back out per query"
+        chunks, bundle = KQL.workspace_chunks(workspaces), KQL.bundle_kql(queries)
+        backend = KQL.bundle_backend()
+
+        def run(chunk):
+            try:
+                return backend(chunk, bundle, timespan)
+            except loganalytics.QueryError as e:
+                if e.kind != "too_large" or len(chunk) > 1:
+                    raise  # for the scheduler to retry, or split so less is materialized
+                # a single workspace's source is over the materialize cap, so scan it per query
+                return [KQL.query_backend()(chunk, query, timespan) for query in queries]
+
+        print("." * len(chunks), end="")
+        errors = []
+        results = loganalytics.scheduler().map(run, chunks, bundle, errors=errors)
+        print("!" * len(results), end="")
+        dfs = []
+        for i, query in enumerate(queries):
+            tables = [result[i] for result in results if len(result) > i and len(result[i])]
+            if not tables:
+                dfs.append(KQL.no_data_df(query, timespan))
+            elif all(isinstance(table, pa.Table) for table in tables):
+                dfs.append(loganalytics.arrow2df(tables))
+            else:
+                dfs.append(pandas.concat(tables))
+            dfs[-1].attrs["partial"] = bool(errors)
+        return dfs
+
+    def query_backend():
+        "The function run for each workspace chunk, from KQL.backend"
+        if callable(KQL.backend):
+            return KQL.backend
+        return {"api": KQL.api_query, "azcli": KQL.azcli_query}[KQL.backend]
+
+    def azcli_query(chunk: list[str], query: str, timespan: str) -> pandas.DataFrame:
+        "Query a chunk of workspaces by forking az monitor log-analytics query"
+        azcli_extension("log-analytics")
+        cmd = ["monitor", "log-analytics", "query", "--workspace", chunk[0], "--analytics-query", query, "--timespan", timespan]
+        if len(chunk) > 1:
+            cmd += ["--workspaces"] + chunk[1:]
+        output = azcli_run(cmd)  # failures raise, for the scheduler to retry or split
+        start = time.perf_counter()
+        df = pandas.read_json(output.decode("utf8"))
+        loganalytics.measure(bytes=len(output), decode=time.perf_counter() - start)
+        return df
+
+    def api_query(chunk: list[str], query: str, timespan: str) -> pandas.DataFrame:
+        "Query a chunk of workspaces in process using the shared log analytics client (errors are retried by the scheduler)"
+        return loganalytics.client().query_arrow(chunk, query, timespan)
+
+    def bundle_backend():
+        "The function run for each workspace chunk of a query bundle, returning a table per query, or None if KQL.backend can't"
+        if callable(KQL.backend):
+            return getattr(KQL.backend, "tables", None)
+        return {"api": KQL.api_tables}.get(KQL.backend)
+
+    def api_tables(chunk: list[str], query: str, timespan: str) -> list[pa.Table]:
+        "Query a chunk of workspaces with a query bundle, returning every result table"
+        return loganalytics.client().query_tables(chunk, query, timespan)
 
     def label_size(dataframe: pandas.DataFrame, category: str, metric: str, max_categories=9, quantile=0.5, max_scale=10, agg="sum", field="oversized"):
         """
         Annotates a dataframe based on quantile and category sizes, then groups small categories into other
         """
-        df = dataframe.copy(deep=True)
-        sizes = df.groupby(category)[metric].agg(agg).sort_values(ascending=False)
+        codes, categories = pandas.factorize(dataframe[category], sort=True)
+        sizes = dataframe[metric].groupby(codes).agg(agg).drop(-1, errors="ignore").sort_values(ascending=False, kind="stable")
         maxmetric = sizes.quantile(quantile) * max_scale
-        normal, oversized = sizes[sizes <= maxmetric], sizes[sizes > maxmetric]
-        df["oversized"] = df[category].isin(oversized.index)
-        for others in (normal[max_categories:], oversized[max_categories:]):
-            df[category] = df[category].replace({label: f"{others.count()} Others" for label in others.index})
+        oversized = sizes > maxmetric
+        labels = pandas.Series(categories, dtype=object)
+        for group in (~oversized, oversized):
+            others = sizes.index[group][max_categories:]
+            labels[others] = f"{len(others)} Others"
+        # relabel and flag rows through their category codes, code -1 (null) maps to the trailing NA / False
+        df = dataframe.copy(deep=False)
+        dtype = df[category].dtype if isinstance(df[category].dtype, pandas.StringDtype) else object
+        df[category] = pandas.array(list(labels) + [pandas.NA], dtype=dtype).take(codes)
+        df[field] = pandas.Series(list(oversized.reindex(labels.index, fill_value=False)) + [False]).to_numpy().take(codes)
         return df
 
     def latest_data(df: pandas.DataFrame, timespan: str, col="TimeGenerated"):
@@ -445,10 +1293,37 @@ class KQL:
         return hashlib.sha256(pickle.dumps(obj)).hexdigest()[:truncate]
 
     def hash_columns(dataframe: pandas.DataFrame, columns: list):
+        "Pseudonymise columns in place with KQL.hash_values"
         if not isinstance(columns, list):
             columns = [columns]
         for column in columns:
-            dataframe[column] = dataframe[column].apply(KQL.hash256)
+            dataframe[column] = KQL.hash_values(dataframe[column])
+
+    def hash_values(values: pandas.Series, truncate: int = 16) -> pandas.Series:
+        """
+        Keyed (KQL.hash_salt) blake2b tokens for a series, hashing each unique value once and mapping back.
+        Full digests are memoised in KQL.hash_memo (per salt, in memory only) and truncated per call; the keyed hash
+        already gives the same tokens in later runs, so the memo is never persisted. Nulls are left as nulls. Warns if no salt is set, as unkeyed tokens can be reversed
+        by hashing a list of likely values (e.g. a directory's user principal names).
+        """
+        if not KQL.hash_salt:
+            warnings.warn("KQL.hash_salt is empty, set REPORT_HASH_SALT (or KQL.hash_salt) to a secret so tokens can't be reversed", stacklevel=2)
+        memo = KQL.hash_memo.setdefault(KQL.salt_fingerprint(), {})
+        salt = KQL.hash_salt.encode("utf8")
+        codes, uniques = pandas.factorize(values)
+        tokens = []
+        for value in map(str, uniques):
+            token = memo.get(value)
+            if token is None:
+                token = memo[value] = hashlib.blake2b(value.encode("utf8"), key=salt, digest_size=32).hexdigest()
+            tokens.append(token[:truncate])
+        tokens = pandas.array(tokens + [pandas.NA], dtype="string")  # code -1 (null) maps to the trailing NA
+        return pandas.Series(tokens.take(codes), index=values.index, name=values.name)
+
+    def salt_fingerprint() -> str:
+        return hashlib.blake2b(KQL.hash_salt.encode("utf8"), digest_size=8).hexdigest()
 
     def show(self, section: str):
+        from IPython import display
+
         return display.HTML(self.report[section].to_html(notebook_mode=True))
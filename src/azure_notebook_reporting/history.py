@@ -0,0 +1,112 @@
+from __future__ import annotations
+import hashlib, pandas
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Union, TYPE_CHECKING
+from .resultcache import normalise_kql, read_parquet
+from .util import atomic_write
+
+if TYPE_CHECKING:
+    from cloudpathlib import AnyPath
+
+iso = lambda t: t.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class HistoryStore:
+    """
+    Per query, per workspace history of query results, partitioned by day:
+    {path}/{query id}/{workspace}/{YYYY-MM-DD}.parquet
+    {path}/{query id}/{workspace}/watermark
+    Refreshing only queries each workspace from its watermark (the start of the day it was last refreshed) to now,
+    so a 12 month trend costs a one day delta query. Results must include TenantId and a time column to partition on.
+    """
+
+    def __init__(self, path: Union[Path, AnyPath], retention: str = "P365D", max_window: str = "P30D"):
+        self.path, self.retention, self.max_window = path, pandas.Timedelta(retention), pandas.Timedelta(max_window)
+
+    def query_id(query: str) -> str:
+        "Editing a query (beyond whitespace / comments) starts a new history"
+        return hashlib.sha256(normalise_kql(query).encode("utf8")).hexdigest()[:16]
+
+    def folder(self, query: str, workspace: str):
+        return self.path / HistoryStore.query_id(query) / workspace
+
+    def watermark(self, query: str, workspace: str) -> Union[pandas.Timestamp, None]:
+        try:
+            return pandas.Timestamp((self.folder(query, workspace) / "watermark").read_text().strip())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def refresh(self, query: str, workspaces: list[str], run, column: str = "TimeGenerated", now: pandas.Timestamp = None):
+        """
+        Query each workspace from its watermark to now with run(workspaces, timespan) -> dataframe, and store the new days.
+        Workspaces sharing a watermark are queried together, in windows of at most max_window aligned to day boundaries.
+        run should raise if any workspace fails: the watermark then only advances to the end of the last window before the failure.
+        """
+        now = now or pandas.Timestamp.utcnow()
+        oldest = (now - self.retention).floor("D")
+        groups = defaultdict(list)
+        for workspace in workspaces:
+            groups[max(self.watermark(query, workspace) or oldest, oldest)].append(workspace)
+        with ThreadPoolExecutor() as executor:
+            for start, group in groups.items():
+                bounds = list(pandas.date_range(start, now, freq=self.max_window)) + [now]
+                windows = [(a, b) for a, b in zip(bounds, bounds[1:]) if b > a]
+                futures = [executor.submit(run, group, f"{iso(a)}/{iso(b)}") for a, b in windows]
+                parts, watermark, failed = [], None, False
+                for (a, b), future in zip(windows, futures):
+                    if future.exception() is not None:
+                        if not failed:
+                            print(f"history refresh of {len(group)} workspaces failed from {iso(a)}: {future.exception()}")
+                        failed = True
+                        continue
+                    if not future.result().empty:
+                        parts.append(future.result())
+                    if not failed:
+                        # only advance past contiguous successful windows, so a failed one is queried again next refresh
+                        watermark = b.floor("D")
+                if parts:
+                    self.store(query, pandas.concat(parts, ignore_index=True), column)
+                if watermark is None:
+                    continue
+                for workspace in group:
+                    folder = self.folder(query, workspace)
+                    folder.mkdir(parents=True, exist_ok=True)
+                    (folder / "watermark").write_text(iso(watermark))
+        self.prune(query, workspaces, oldest)
+
+    def store(self, query: str, df: pandas.DataFrame, column: str):
+        "Write (overwriting) one partition per workspace and day"
+        if "TenantId" not in df.columns or column not in df.columns:
+            raise ValueError(f"history queries must return TenantId and {column}")
+        days = pandas.to_datetime(df[column], utc=True).dt.strftime("%Y-%m-%d")
+        for (workspace, day), part in df.groupby([df["TenantId"], days]):
+            folder = self.folder(query, workspace)
+            folder.mkdir(parents=True, exist_ok=True)
+            with atomic_write(folder / f"{day}.parquet") as tmp, tmp.open("wb") as f:
+                part.reset_index(drop=True).to_parquet(f)
+
+    def partitions(self, query: str, workspace: str, since: pandas.Timestamp = None) -> list:
+        files = self.folder(query, workspace).glob("*.parquet")
+        return sorted(f for f in files if since is None or f.stem >= since.strftime("%Y-%m-%d"))
+
+    def load(self, query: str, workspaces: list[str], since: pandas.Timestamp = None) -> Union[pandas.DataFrame, None]:
+        "Merged history for workspaces (from since, if given), or None if nothing is stored"
+
+        def read(partition):
+            with partition.open("rb") as f:
+                return read_parquet(f)
+
+        files = [partition for workspace in workspaces for partition in self.partitions(query, workspace, since)]
+        if not files:
+            return None
+        with ThreadPoolExecutor() as executor:
+            return pandas.concat(executor.map(read, files), ignore_index=True)
+
+    def prune(self, query: str, workspaces: list[str], oldest: pandas.Timestamp):
+        "Remove partitions that have fallen out of retention"
+        for workspace in workspaces:
+            for partition in self.partitions(query, workspace):
+                if partition.stem < oldest.strftime("%Y-%m-%d"):
+                    partition.unlink()
@@ -0,0 +1,357 @@
+import hashlib, json, random, threading, time, pandas, pyarrow as pa, pyarrow.compute as pc, requests
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+from .util import Singleton
+
+# kusto column types -> arrow types, anything unlisted (dynamic, timespan, guid) is kept as text
+kusto_types = {
+    "bool": pa.bool_(),
+    "boolean": pa.bool_(),
+    "int": pa.int64(),
+    "long": pa.int64(),
+    "real": pa.float64(),
+    "double": pa.float64(),
+    "decimal": pa.float64(),
+    "datetime": pa.timestamp("ns", tz="UTC"),
+}
+
+# arrow types -> pandas nullable dtypes, strings stay arrow backed
+pandas_types = {
+    pa.bool_(): pandas.BooleanDtype(),
+    pa.int64(): pandas.Int64Dtype(),
+    pa.float64(): pandas.Float64Dtype(),
+    pa.string(): pandas.StringDtype("pyarrow"),
+}
+
+
+class QueryError(Exception):
+    """
+    A failed log analytics request, classified so QueryScheduler can decide what to do with it:
+    throttled / transient - retry after backoff (or Retry-After), timeout / too_large - split the chunk, error - give up
+    """
+
+    def __init__(self, message: str, kind: str = "error", retry_after: float = 0):
+        super().__init__(message)
+        self.kind, self.retry_after = kind, retry_after
+
+
+def classify(response: requests.Response) -> QueryError:
+    "Turn a failed api response into a QueryError"
+    retry_after = float(response.headers.get("Retry-After", 0) or 0)
+    message = f"{response.status_code}: {response.text[:500]}"
+    if response.status_code == 429:
+        return QueryError(message, "throttled", retry_after)
+    if response.status_code in (408, 504):
+        return QueryError(message, "timeout", retry_after)
+    if response.status_code >= 500:
+        return QueryError(message, "transient", retry_after)
+    if "limit" in response.text.lower():
+        return QueryError(message, "too_large")
+    return QueryError(message)
+
+
+def classify_text(message: str) -> QueryError:
+    "Classify a failure from its message, e.g. az cli stderr"
+    text = message.lower()
+    if "429" in text or "throttl" in text or "too many requests" in text:
+        return QueryError(message, "throttled")
+    if "timeout" in text or "timed out" in text:
+        return QueryError(message, "timeout")
+    if "limit" in text:
+        return QueryError(message, "too_large")
+    if "503" in text or "502" in text or "connection" in text:
+        return QueryError(message, "transient")
+    return QueryError(message)
+
+
+def tables2arrow(response: dict, table: int = 0) -> pa.Table:
+    """
+    Decode a log analytics query api response into an arrow table, typing each column once from the kusto column types.
+    Dynamic columns are kept as json text, matching the azure cli.
+    Adds a TableName column so results line up with `az monitor log-analytics query` output.
+    """
+    tables = response.get("tables", [])
+    if not tables or not tables[table]["rows"]:
+        return pa.table({})
+    result, rows = tables[table], tables[table]["rows"]
+    columns = {}
+    for i, column in enumerate(result["columns"]):
+        kind, data = kusto_types.get(column["type"], pa.string()), [row[i] for row in rows]
+        try:
+            if pa.types.is_timestamp(kind):
+                columns[column["name"]] = pa.array(data, pa.string()).cast(kind)
+            else:
+                columns[column["name"]] = pa.array(data, kind)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # e.g. dynamic values returned as json objects rather than text
+            columns[column["name"]] = pa.array([v if v is None or isinstance(v, str) else json.dumps(v) for v in data], pa.string())
+    columns["TableName"] = pa.array([result["name"]] * len(rows), pa.string())
+    return pa.table(columns)
+
+
+def arrow2df(tables: list[pa.Table]) -> pandas.DataFrame:
+    """
+    Concatenate chunk results (without copying) and convert to pandas once.
+    Chunks with differing columns (e.g. evaluate pivot) are null filled, conflicting types fall back to text.
+    """
+    tables = [t for t in tables if t.num_rows]
+    if not tables:
+        return pandas.DataFrame()
+    try:
+        table = pa.concat_tables(tables, promote_options="default")
+    except pa.ArrowInvalid:
+        table = pa.concat_tables([t.cast(pa.schema([(f.name, pa.string()) for f in t.schema])) for t in tables], promote_options="default")
+    df = table.to_pandas(types_mapper=pandas_types.get)
+    df.attrs["typed"] = True  # tidy can skip coercion
+    return df
+
+
+def tables2df(response: dict, table: int = 0) -> pandas.DataFrame:
+    "Decode a log analytics query api response straight into typed columns"
+    return arrow2df([tables2arrow(response, table)])
+
+
+class LogAnalyticsClient:
+    """
+    In process log analytics query client, sharing one pooled http session and a cached bearer token across threads.
+    """
+
+    endpoint = "https://api.loganalytics.io/v1"
+    scope = "https://api.loganalytics.io/.default"
+
+    def __init__(self, endpoint: str = "", credential=None, pool_size: int = 32, timeout: int = 600):
+        self.endpoint = endpoint or self.endpoint
+        self.credential, self.timeout = credential, timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._token, self._lock = None, threading.Lock()
+
+    def token(self) -> str:
+        "Return a cached bearer token, refreshing 5 minutes before it expires"
+        with self._lock:
+            if not self._token or self._token.expires_on - 300 < time.time():
+                if not self.credential:
+                    from azure.identity import DefaultAzureCredential
+
+                    # managed identity on compute instances, az login locally
+                    self.credential = DefaultAzureCredential()
+                self._token = self.credential.get_token(self.scope)
+            return self._token.token
+
+    def post(self, workspaces: list[str], query: str, timespan: str) -> requests.Response:
+        body = {"query": query, "timespan": timespan}
+        if len(workspaces) > 1:
+            body["workspaces"] = workspaces[1:]
+        try:
+            response = self.session.post(
+                f"{self.endpoint}/workspaces/{workspaces[0]}/query",
+                json=body,
+                headers={"Authorization": f"Bearer {self.token()}", "Prefer": "wait=600"},
+                timeout=self.timeout,
+            )
+        except requests.Timeout as e:
+            raise QueryError(str(e), "timeout")
+        except requests.ConnectionError as e:
+            raise QueryError(str(e), "transient")
+        if not response.ok:
+            raise classify(response)
+        return response
+
+    def query(self, workspaces: list[str], query: str, timespan: str) -> pandas.DataFrame:
+        "Query up to 20 workspaces in a single request, returning the primary result as a dataframe"
+        return arrow2df([self.query_arrow(workspaces, query, timespan)])
+
+    def query_arrow(self, workspaces: list[str], query: str, timespan: str) -> pa.Table:
+        "Query up to 20 workspaces in a single request, returning the primary result as an arrow table"
+        return (self.query_tables(workspaces, query, timespan) or [pa.table({})])[0]
+
+    def query_tables(self, workspaces: list[str], query: str, timespan: str) -> list[pa.Table]:
+        "Query up to 20 workspaces in a single request, returning every result table (one per statement of a batch) as arrow tables"
+        response = self.post(workspaces, query, timespan)
+        start = time.perf_counter()
+        content, response = response.content, response.json()
+        if "error" in response:
+            # partial results, e.g. over the 500k row / 64MB response limits - raise rather than return truncated data
+            error = response["error"]
+            kind = "too_large" if "limit" in str(error).lower() else "error"
+            raise QueryError(f"{error.get('code')}: {error.get('message')}", kind)
+        tables = [tables2arrow(response, i) for i in range(len(response.get("tables", [])))]
+        measure(bytes=len(content), decode=time.perf_counter() - start)
+        return tables
+
+
+# pooled connections can't be shared with forked children, so render_fleet workers create their own
+client = Singleton(LogAnalyticsClient, "Shared LogAnalyticsClient", per_process=True)
+
+
+_measured = threading.local()
+
+
+def measure(**stats):
+    "Record response stats (bytes, decode seconds) for the chunk running on this thread, picked up by QueryScheduler"
+    if hasattr(_measured, "stats"):
+        _measured.stats.update(stats)
+
+
+def query_id(query: str) -> str:
+    return hashlib.sha256(query.encode("utf8")).hexdigest()[:16]
+
+
+def workspace_rows(result) -> dict:
+    "Rows per TenantId in a chunk's result (arrow table, dataframe or a list of them for query bundles), if it has one"
+    if isinstance(result, list):
+        return dict(sum((Counter(workspace_rows(table)) for table in result), Counter()))
+    if isinstance(result, pa.Table) and "TenantId" in result.column_names:
+        counts = pc.value_counts(result["TenantId"])
+        return dict(zip(counts.field("values").to_pylist(), counts.field("counts").to_pylist()))
+    if isinstance(result, pandas.DataFrame) and "TenantId" in result.columns:
+        return result["TenantId"].value_counts().to_dict()
+    return {}
+
+
+def result_rows(result) -> int:
+    "Rows in a chunk's result, summed over the tables of a query bundle"
+    if isinstance(result, list):
+        return sum(len(table) for table in result)
+    return 0 if result is None else len(result)
+
+
+class Telemetry:
+    """
+    Structured events for query execution, one per chunk attempt (stage "chunk") and one per KQL.kql2df call (stage "query").
+    Chunk events record queue wait, wall time, response bytes, decode time, rows (and rows per workspace), attempt and error kind.
+    Events are kept in memory for frame(), and appended to a json lines trace file if one is given.
+    Each event is tagged with the current run (see start_run), so a report only counts its own run's requests.
+    """
+
+    def __init__(self, trace=None):
+        self.trace, self.events, self.labels, self.run = trace, [], {}, 0
+        self._lock = threading.Lock()
+
+    def start_run(self) -> int:
+        "Tag events recorded from now on with a new run id, and return it"
+        with self._lock:
+            self.run += 1
+            return self.run
+
+    def label(self, query: str, name: str):
+        "Name events for query text, e.g. with the kql file it was read from"
+        self.labels[query_id(query)] = name
+
+    def record(self, stage: str, query: str, workspaces: list[str], **stats):
+        qid = query_id(query)
+        event = {"time": time.time(), "stage": stage, "name": self.labels.get(qid, qid), "query_id": qid, "workspaces": list(workspaces), **stats}
+        with self._lock:
+            event["run"] = self.run
+            self.events.append(event)
+            if self.trace:
+                with open(self.trace, "a") as f:
+                    f.write(json.dumps(event, default=str) + "\n")
+
+    def frame(self, run: int = None) -> pandas.DataFrame:
+        "Events as a dataframe, only those of run if given"
+        with self._lock:
+            return pandas.DataFrame([event for event in self.events if run is None or event["run"] == run])
+
+    def clear(self):
+        with self._lock:
+            self.events.clear()
+
+
+telemetry = Singleton(Telemetry, "Shared Telemetry")
+
+
+class QueryScheduler:
+    """
+    Runs workspace chunks for every query on one shared pool, with at most max_inflight requests at a time.
+    Throttled and transient failures are retried with exponential backoff (honouring Retry-After),
+    chunks that time out or exceed result size limits are split in half and rescheduled.
+    counters tracks requests, retries, splits and failures for tuning, and each attempt is recorded in telemetry().
+    """
+
+    retryable = ("throttled", "transient", "timeout")
+
+    def __init__(self, max_inflight: int = 5, max_retries: int = 5, backoff: float = 2, max_backoff: float = 120):
+        # api limits are 5 concurrent queries per user: https://learn.microsoft.com/en-us/azure/azure-monitor/service-limits#la-query-api
+        self.max_inflight, self.max_retries, self.backoff, self.max_backoff = max_inflight, max_retries, backoff, max_backoff
+        self.slots = threading.BoundedSemaphore(max_inflight)
+        self.executor = ThreadPoolExecutor(max_workers=max_inflight * 4, thread_name_prefix="kql")
+        self.counters, self._lock = Counter(), threading.Lock()
+
+    def count(self, counter: str, n: int = 1):
+        with self._lock:
+            self.counters[counter] += n
+
+    def map(self, run, chunks: list[list[str]], query: str = "", strict: bool = False, errors: list = None) -> list:
+        """
+        Call run(chunk) for every chunk (and any split halves), returning the non empty results (dataframes, arrow tables or lists of them for query bundles).
+        Chunks that still fail after retries are left out (their QueryErrors appended to errors, if given),
+        unless strict is set: then once every chunk is done the first failure is raised.
+        """
+        results, errors = [], [] if errors is None else errors
+        pending = {self.executor.submit(self.attempt, run, chunk, query): chunk for chunk in chunks}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                chunk = pending.pop(f)
+                df, split, error = f.result()
+                if split:
+                    middle = len(chunk) // 2
+                    for half in (chunk[:middle], chunk[middle:]):
+                        pending[self.executor.submit(self.attempt, run, half, query)] = half
+                elif error:
+                    errors.append(error)
+                elif df is not None and result_rows(df):
+                    results.append(df)
+        if strict and errors:
+            raise errors[0]
+        return results
+
+    def attempt(self, run, chunk: list[str], query: str = ""):
+        "Run one chunk with retries, returning (dataframe, False, None), (None, True, None) if it should be split, or (None, False, error) if it failed"
+        queued = time.perf_counter()
+        for retry in range(self.max_retries + 1):
+            with self.slots:
+                self.count("requests")
+                started, result, error = time.perf_counter(), None, None
+                _measured.stats = {"bytes": 0, "decode": 0.0}
+                try:
+                    result = run(chunk)
+                except QueryError as e:
+                    error = e
+                except Exception as e:
+                    error = QueryError(str(e))
+                stats = _measured.__dict__.pop("stats")
+                telemetry().record(
+                    "chunk",
+                    query,
+                    chunk,
+                    attempt=retry,
+                    queue_wait=started - queued,
+                    wall=time.perf_counter() - started,
+                    rows=result_rows(result),
+                    workspace_rows=workspace_rows(result),
+                    error=error.kind if error else "",
+                    **stats,
+                )
+                if error is None:
+                    return result, False, None
+            if error.kind in ("timeout", "too_large") and len(chunk) > 1:
+                self.count("splits")
+                return None, True, None
+            if error.kind not in self.retryable or retry == self.max_retries:
+                break
+            self.count("retries")
+            delay = error.retry_after or min(self.backoff * 2**retry, self.max_backoff) * random.uniform(0.5, 1)
+            time.sleep(delay)
+            queued = time.perf_counter()
+        self.count("failures")
+        print(f"{error.kind} querying {len(chunk)} workspaces: {error}")
+        return None, False, error
+
+
+# threads don't survive a fork, so render_fleet workers create their own
+scheduler = Singleton(QueryScheduler, "Shared QueryScheduler", per_process=True)
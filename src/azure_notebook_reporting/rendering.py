@@ -0,0 +1,171 @@
+from __future__ import annotations
+import io, os, shutil, tempfile, threading, pandas
+from concurrent.futures import ProcessPoolExecutor, Future
+from datetime import datetime
+from typing import TYPE_CHECKING
+from pathvalidate import sanitize_filename
+from .util import Singleton
+
+if TYPE_CHECKING:
+    import esparto
+
+
+def report_date(created: datetime = None) -> datetime:
+    "Creation time recorded in report metadata, midnight today unless given, so reruns write identical files for uploads to skip"
+    return pandas.Timestamp(created or "today").normalize().to_pydatetime().replace(tzinfo=None)
+
+
+def render_pdf(page: esparto.Page, pdf_file, css_file: str, created: datetime = None) -> str:
+    """
+    Lay out and save a pdf with weasyprint (as esparto's save_pdf, but with fixed creation and modification dates),
+    returning the rendered html
+    """
+    import esparto, weasyprint
+    from esparto.publish.output import publish_html, prettify_html
+
+    # esparto options are process globals, so set css and a private figure dir for this job
+    esparto.options.esparto_css = css_file
+    esparto.options._pdf_temp_dir = tempfile.mkdtemp()
+    try:
+        html = publish_html(page, filepath=None, return_html=True, dependency_source="inline", pdf_mode=True)
+        document = weasyprint.HTML(string=html, base_url=esparto.options._pdf_temp_dir).render()
+        document.metadata.title = page.title
+        document.metadata.created = document.metadata.modified = report_date(created).strftime("%Y-%m-%dT%H:%M:%SZ")
+        document.write_pdf(pdf_file)
+    finally:
+        shutil.rmtree(esparto.options._pdf_temp_dir, ignore_errors=True)
+    return prettify_html(html)
+
+
+def render_html(page: esparto.Page, html_file, css_file: str):
+    "Save a standalone html copy of the report (figures inlined)"
+    import esparto
+    from esparto.publish.output import publish_html
+
+    esparto.options.esparto_css = css_file
+    html = publish_html(page, filepath=None, return_html=True, dependency_source="inline")
+    with html_file.open("w+t") as f:
+        f.write(html)
+    return html_file
+
+
+def render_figure(df: pandas.DataFrame, plot: dict, format: str = "png", dpi: int = 150, theme: dict = None) -> bytes:
+    "Rasterise df.plot(**plot) with the report's seaborn theme, returning png (or svg) bytes"
+    import matplotlib
+
+    matplotlib.use("agg")
+    import matplotlib.pyplot as plt
+
+    if theme:
+        import seaborn
+
+        seaborn.set_theme(**theme)
+    axes = df.plot(**plot)
+    figure = getattr(axes, "flat", [axes])[0].figure  # subplots=True returns an array of axes
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format=format, dpi=dpi)
+    plt.close(figure)
+    return buffer.getvalue()
+
+
+excel_rows = 1048575  # excel's sheet limit, less the header row
+
+
+def excel_chunk(df: pandas.DataFrame) -> list:
+    "Python values for each column of a chunk, as xlsxwriter's write_row takes them"
+    columns = []
+    for name, column in df.items():
+        if isinstance(column.dtype, pandas.DatetimeTZDtype):
+            column = column.dt.tz_localize(None)  # timezones are unsupported by excel
+        values = column.astype(object)
+        values = values.where(values.notna(), None).tolist()
+        if column.dtype == object:
+            # dynamic columns (lists / dicts) as text
+            values = [v if v is None or isinstance(v, (str, int, float, bool)) else str(v) for v in values]
+        columns.append(values)
+    return columns
+
+
+def write_excel(
+    dfs: dict({str: pandas.DataFrame}),
+    excel_file,
+    max_rows: int = None,
+    sample: bool = False,
+    bulk: str = None,
+    chunksize: int = 10000,
+    created: datetime = None,
+):
+    """
+    Write each dataframe to a sheet (dropping TableName), streaming rows with xlsxwriter's constant_memory mode
+    so only the current row is held in memory. The dataframes are not modified.
+    Sheets are capped at max_rows (and excel's 1048575 row limit), keeping the first rows, or a random sample if sample is set.
+    bulk="parquet" or "csv.gz" also writes each full (uncapped) dataframe to {excel_file stem}-{sheet}.{bulk} for bulk consumers.
+    The workbook's creation time is report_date(created), so the same results always produce the same file.
+    """
+    import xlsxwriter
+
+    with excel_file.open("wb") as f:
+        workbook = xlsxwriter.Workbook(f, {"constant_memory": True, "default_date_format": "yyyy-mm-dd hh:mm:ss", "strings_to_urls": False})
+        workbook.set_properties({"created": report_date(created)})
+        for name, df in dfs.items():
+            df = df.drop("TableName", axis=1, errors="ignore")
+            if bulk:
+                write_bulk(df, excel_file.with_name(f"{excel_file.stem}-{sanitize_filename(name)}.{bulk}"), bulk)
+            if not isinstance(df.index, pandas.RangeIndex):
+                df = df.reset_index()
+            rows = min(max_rows or excel_rows, excel_rows)
+            if len(df) > rows:
+                df = df.sample(rows, random_state=0).sort_index() if sample else df.head(rows)
+            worksheet = workbook.add_worksheet(name[:31])
+            worksheet.write_row(0, 0, [" ".join(map(str, c)) if isinstance(c, tuple) else str(c) for c in df.columns])
+            for start in range(0, len(df), chunksize):
+                for offset, row in enumerate(zip(*excel_chunk(df.iloc[start : start + chunksize]))):
+                    worksheet.write_row(start + offset + 1, 0, row)
+        workbook.close()
+    return excel_file
+
+
+def write_bulk(df: pandas.DataFrame, bulk_file, format: str):
+    with bulk_file.open("wb") as f:
+        if format == "parquet":
+            df.to_parquet(f)
+        elif format == "csv.gz":
+            df.to_csv(f, index=False, compression={"method": "gzip", "mtime": 0})  # no timestamp in the gzip header
+        else:
+            raise ValueError(f"unknown bulk format {format}, expected parquet or csv.gz")
+
+
+class RenderPool:
+    """
+    Process pool for cpu heavy report rendering (pdf layout, html and excel export).
+    At most max_pending jobs are submitted at once (submit blocks until a slot frees up),
+    which bounds how many pickled pages and dataframes are held in memory on small compute instances.
+    """
+
+    def __init__(self, max_workers: int = None, max_pending: int = None):
+        self.max_workers = max_workers or os.cpu_count()
+        self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        self.slots = threading.BoundedSemaphore(max_pending or self.max_workers * 2)
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+        return future
+
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+# a forked copy of the pool has no management thread, so render_fleet workers create their own
+pool = Singleton(RenderPool, "Shared RenderPool", close=RenderPool.shutdown, per_process=True)
@@ -0,0 +1,123 @@
+from __future__ import annotations
+import hashlib, time, pandas, pyarrow as pa, pyarrow.parquet as pq
+from pathlib import Path
+from typing import Union, TYPE_CHECKING
+from .util import atomic_write
+
+if TYPE_CHECKING:
+    from cloudpathlib import AnyPath
+
+
+def read_parquet(f) -> pandas.DataFrame:
+    "Read a parquet file keeping strings arrow backed, as query results are decoded"
+    return pq.read_table(f).to_pandas(types_mapper={pa.string(): pandas.StringDtype("pyarrow")}.get)
+
+
+def normalise_kql(query: str) -> str:
+    "Strip whitespace, blank lines and full line comments so cosmetic edits don't change the cache key"
+    lines = [line.strip() for line in query.strip().splitlines()]
+    return "\n".join(line for line in lines if line and not line.startswith("//"))
+
+
+class ResultCache:
+    """
+    Content addressed, on disk store of query results saved as parquet.
+    path can be a local directory or a folder under a BlobPath container, so results are shared between papermill runs.
+    Entries expire after ttl seconds, and the least recently used entries are evicted once the store exceeds maxsize bytes.
+    The store is only listed (an http call per entry on blob storage) on the first write and whenever the bytes written since
+    take it over maxsize, rather than on every write.
+    """
+
+    def __init__(self, path: Union[Path, AnyPath], ttl: int = 86400, maxsize: int = 2 * 1024**3, suffix: str = ".parquet"):
+        self.path, self.ttl, self.maxsize, self.suffix = path, ttl, maxsize, suffix
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.hits = self.misses = 0
+        self.size = None  # bytes in the store as of the last evict, plus those written since
+
+    def key(query: str, workspaces: list[str], timespan: str) -> str:
+        "sha256 of the normalised kql, sorted workspace ids and timespan"
+        content = "\n".join([normalise_kql(query), ",".join(sorted(workspaces)), timespan])
+        return hashlib.sha256(content.encode("utf8")).hexdigest()
+
+    def entry(self, key: str):
+        # a zero byte .hit file alongside each entry records last access, as blob storage has no atime
+        return self.path / f"{key}{self.suffix}", self.path / f"{key}.hit"
+
+    def get(self, key: str) -> Union[pandas.DataFrame, None]:
+        "Return a cached dataframe, or None if missing or older than ttl"
+        return self.load(key, read_parquet)
+
+    def get_bytes(self, key: str) -> Union[bytes, None]:
+        "Return a cached file's content (e.g. a rendered figure), or None if missing or older than ttl"
+        return self.load(key, lambda f: f.read())
+
+    def load(self, key: str, read):
+        data, hit = self.entry(key)
+        try:
+            if time.time() - data.stat().st_mtime > self.ttl:
+                self.misses += 1
+                return None
+            with data.open("rb") as f:
+                value = read(f)
+        except (FileNotFoundError, OSError):
+            self.misses += 1
+            return None
+        hit.touch()
+        self.hits += 1
+        return value
+
+    def set(self, key: str, df: pandas.DataFrame):
+        "Store a dataframe, then evict old entries if the store is over size"
+        self.store(key, df.to_parquet)
+
+    def set_bytes(self, key: str, content: bytes):
+        "Store a file's content, then evict old entries if the store is over size"
+        self.store(key, lambda f: f.write(content))
+
+    def store(self, key: str, write):
+        data, hit = self.entry(key)
+        try:
+            with atomic_write(data) as tmp:
+                with tmp.open("wb") as f:
+                    write(f)
+                written = tmp.stat().st_size
+        except Exception as e:
+            # e.g. mixed type dynamic columns that arrow can't represent
+            print(e)
+            return
+        hit.touch()
+        if self.size is not None:
+            self.size += written
+        if self.size is None or self.size > self.maxsize:
+            self.evict()
+
+    def evict(self):
+        "Remove expired entries, then least recently used entries until under maxsize, and record the remaining size"
+        entries, now = [], time.time()
+        for data in self.path.glob(f"*{self.suffix}"):
+            hit = data.with_suffix(".hit")
+            stat = data.stat()
+            accessed = max(stat.st_mtime, hit.stat().st_mtime if hit.exists() else 0)
+            if now - stat.st_mtime > self.ttl:
+                self.remove(data)
+            else:
+                entries.append((accessed, stat.st_size, data))
+        total = sum(size for accessed, size, data in entries)
+        for accessed, size, data in sorted(entries, key=lambda e: e[0]):
+            if total <= self.maxsize:
+                break
+            self.remove(data)
+            total -= size
+        self.size = total
+
+    def remove(self, data):
+        for path in (data, data.with_suffix(".hit")):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        for data in self.path.glob(f"*{self.suffix}"):
+            self.remove(data)
+        self.size = 0
@@ -0,0 +1,71 @@
+import json, os, shutil, tempfile, uuid, pandas, pyarrow as pa
+from pathlib import Path
+from typing import Union
+from .loganalytics import pandas_types
+from .util import atomic_write
+
+
+class SharedStore:
+    """
+    Local store of dataframes as uncompressed arrow ipc (feather v2) files, for sibling worker processes to share.
+    publish writes a dataframe once; attach memory maps it read only, so string columns (most of a query result)
+    are backed by the shared page cache rather than copied into each process. Numeric columns are converted to
+    the nullable dtypes used by query results. Defaults to a folder under /dev/shm where available.
+    """
+
+    def __init__(self, path: Union[str, Path] = None):
+        if path is None:
+            path = tempfile.mkdtemp(prefix="kql-shared-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.published = {}  # id(df) -> (df, name), so a dataframe shared by several reports is written once
+
+    def publish(self, df: pandas.DataFrame, name: str = "") -> Union[str, None]:
+        "Write df (if not already published) and return its name, or None if arrow can't represent it"
+        if id(df) in self.published:
+            return self.published[id(df)][1]
+        name = name or uuid.uuid4().hex
+        try:
+            table = pa.Table.from_pandas(df)
+            table = table.replace_schema_metadata({**table.schema.metadata, b"attrs": json.dumps(df.attrs, default=str)})
+        except (pa.ArrowException, ValueError, TypeError) as e:
+            # e.g. mixed type object columns
+            print(e)
+            return None
+        with atomic_write(self.path / f"{name}.arrow") as tmp, pa.OSFile(str(tmp), "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        self.published[id(df)] = (df, name)
+        return name
+
+    def __getstate__(self):
+        # workers only attach, don't pickle the parent's published dataframes
+        return {**self.__dict__, "published": {}}
+
+    def attach(self, name: str) -> pandas.DataFrame:
+        "Memory map a published dataframe read only"
+        table = pa.ipc.open_file(pa.memory_map(str(self.path / f"{name}.arrow"), "r")).read_all()
+        df = table.to_pandas(types_mapper=pandas_types.get)
+        metadata = table.schema.pandas_metadata or {}
+        if df.index.nlevels == 1 and metadata.get("index_columns") and isinstance(metadata["index_columns"][0], str):
+            # the types mapper also applies to the index, restore its numpy dtype
+            numpy_type = next(c["numpy_type"] for c in metadata["columns"] if c["field_name"] == metadata["index_columns"][0])
+            df.index = df.index.astype(numpy_type)
+        df.attrs = json.loads(table.schema.metadata.get(b"attrs", b"{}"))
+        return df
+
+    def write_manifest(self, name: str, manifest: dict):
+        with atomic_write(self.path / f"{name}.json") as tmp:
+            tmp.write_text(json.dumps(manifest))
+
+    def read_manifest(self, name: str) -> dict:
+        return json.loads((self.path / f"{name}.json").read_text())
+
+    def clear(self):
+        self.published.clear()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.clear()
@@ -0,0 +1,115 @@
+import random, time, pandas, pyarrow as pa
+from . import loganalytics
+
+# output columns of the notebooks/kql/siemhealth queries, matched on a column name that only appears in that query
+siemhealth_schemas = {
+    "IngestionVolume": [("Table", "string"), ("TimeGenerated", "datetime"), ("TenantId", "string"), ("IngestionVolume", "real")],
+    "DeliveryAction": [("DeliveryAction", "string"), ("EmailDirection", "string"), ("TimeGenerated", "datetime"), ("TenantId", "string"), ("Count", "long")],
+    "IncidentNumber": [
+        ("IncidentNumber", "long"),
+        ("TenantId", "string"),
+        ("TimeGenerated", "datetime"),
+        ("Rule", "string"),
+        ("Tactics", "string"),
+        ("Severity", "string"),
+        ("Status", "string"),
+        ("Classification", "string"),
+        ("ClosedTime", "datetime"),
+        ("CreatedTime", "datetime"),
+        ("FirstModifiedTime", "datetime"),
+        ("OpenHours", "real"),
+        ("TriageHours", "real"),
+    ],
+    "Download Count": [("Guest Domain", "string"), ("Download Count", "long")],
+    "FileUrl": [("FileUrl", "string"), ("Count", "long")],
+    "logontype": [("logontype", "string"), ("users", "long"), ("devices", "long"), ("dcs", "string")],
+    "ClientAppUsed": [("ClientAppUsed", "string"), ("Logins", "long"), ("UserCount", "long"), ("Users", "string")],
+    "IsLocalAdmin": [("AccountName", "string"), ("Devices", "long")],
+    "OSPlatform": [("OSPlatform", "string"), ("devices", "long"), ("ASREnabled", "long")],
+    "device_count": [("user", "string"), ("device_count", "long"), ("devices", "string")],
+    "pivot(": [("UserPrincipalName", "string"), ("Password", "long"), ("PhoneAppNotification", "long"), ("FIDO2 security key", "long")],
+    "AppDisplayName": [
+        ("AppDisplayName", "string"),
+        ("Location", "string"),
+        ("Signins", "long"),
+        ("UserCount", "long"),
+        ("IPCount", "long"),
+        ("Users", "string"),
+    ],
+    "SecurityAlert": [("TenantId", "string"), ("LastAlert", "datetime")],
+}
+default_schema = [("TimeGenerated", "datetime"), ("TenantId", "string"), ("Count", "long")]
+
+
+class SimulatedBackend:
+    """
+    Offline stand in for log analytics, for KQL.backend in tests and benchmarks: KQL.backend = SimulatedBackend(...).
+    Returns rows synthetic rows per workspace, with columns shaped like the siemhealth query outputs (see schemas),
+    after sleeping around latency seconds. failure_rate of requests raise throttled or transient QueryErrors,
+    and chunks of more than max_workspaces time out, so the scheduler's retries and splits are exercised.
+    tables answers query bundles, with a result table per statement. Bundles that materialize more than materialize_rows
+    rows (rows per workspace x workspaces) fail as too_large, like kusto's 5GB materialize cap.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        failure_rate: float = 0.0,
+        rows: int = 10,
+        max_workspaces: int = 20,
+        seed: int = 0,
+        schemas: dict = siemhealth_schemas,
+        materialize_rows: int = None,
+    ):
+        self.latency, self.failure_rate, self.rows, self.max_workspaces, self.schemas = latency, failure_rate, rows, max_workspaces, schemas
+        self.materialize_rows = materialize_rows
+        self.random, self.requests = random.Random(seed), 0
+
+    def schema(self, query: str) -> list:
+        return next((columns for marker, columns in self.schemas.items() if marker in query), default_schema)
+
+    def window(self, timespan: str):
+        if "/" in timespan:
+            start, end = (pandas.Timestamp(t) for t in timespan.split("/"))
+        else:
+            end = pandas.Timestamp("2022-11-01", tz="UTC")
+            start = end - pandas.Timedelta(timespan)
+        return start, end
+
+    def value(self, name: str, kind: str, i: int, workspace: str, start: pandas.Timestamp, step: pandas.Timedelta):
+        if name == "TenantId":
+            return workspace
+        if kind == "datetime":
+            return (start + step * i).strftime("%Y-%m-%dT%H:%M:%SZ")
+        if kind == "long":
+            return self.random.randint(0, 1000)
+        if kind == "real":
+            return round(self.random.uniform(0, 100), 3)
+        return f"{name.lower()}{i % 7}"
+
+    def __call__(self, chunk: list[str], query: str, timespan: str) -> pa.Table:
+        return self.request(chunk, [query], timespan)[0]
+
+    def tables(self, chunk: list[str], query: str, timespan: str) -> list[pa.Table]:
+        "A query bundle (KQL.bundle_kql) in one request, returning a table per tabular statement"
+        statements = [s for s in query.split(";\n") if not s.lstrip().startswith("let ")]
+        return self.request(chunk, statements, timespan, materialized="materialize(" in query)
+
+    def request(self, chunk: list[str], queries: list[str], timespan: str, materialized: bool = False) -> list[pa.Table]:
+        self.requests += 1
+        time.sleep(self.latency * self.random.uniform(0.5, 1.5))
+        if len(chunk) > self.max_workspaces:
+            raise loganalytics.QueryError(f"simulated timeout querying {len(chunk)} workspaces", "timeout")
+        if materialized and self.materialize_rows is not None and len(chunk) * self.rows > self.materialize_rows:
+            raise loganalytics.QueryError("simulated E_RUNAWAY_QUERY: materialize exceeded the memory limit", "too_large")
+        if self.random.random() < self.failure_rate:
+            raise loganalytics.QueryError("simulated failure", self.random.choice(["throttled", "transient"]))
+        start, end = self.window(timespan)
+        step = (end - start) / self.rows
+        response = {"tables": []}
+        for n, query in enumerate(queries):
+            columns = self.schema(query)
+            rows = [[self.value(name, kind, i, workspace, start, step) for name, kind in columns] for workspace in chunk for i in range(self.rows)]
+            table = "PrimaryResult" if n == 0 else f"Table_{n}"
+            response["tables"].append({"name": table, "columns": [{"name": name, "type": kind} for name, kind in columns], "rows": rows})
+        return [loganalytics.tables2arrow(response, n) for n in range(len(queries))]
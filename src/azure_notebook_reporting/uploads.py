@@ -0,0 +1,126 @@
+import hashlib, mimetypes, shutil, tempfile, time, pandas
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from pathlib import Path
+from typing import Union
+from .util import Singleton, atomic_write
+
+block_size = 4 * 1024 * 1024  # blob block size, files over max_single_put_size are uploaded in blocks of this size
+max_single_put_size = 8 * 1024 * 1024
+
+
+def file_hash(path: Path) -> str:
+    "sha256 hex digest of a file, read in blocks"
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def content_type_for(path: Path) -> str:
+    """
+    Blob Content-Type for a file. Compressed files (e.g. .csv.gz) are archives, not transfer encoded content,
+    so they get their archive type and never a Content-Encoding (browsers would otherwise silently decompress them)
+    """
+    content_type, encoding = mimetypes.guess_type(path.name)
+    if encoding:
+        return {"gzip": "application/gzip", "bzip2": "application/x-bzip2", "xz": "application/x-xz"}.get(encoding, "application/octet-stream")
+    return content_type or "application/octet-stream"
+
+
+class Uploader:
+    """
+    Output stage for report artefacts. Reports are written to a local buffer folder (stage), then upload sends
+    the folder's files to their destination concurrently, max_workers files at a time with max_concurrency blocks per file.
+    Blob destinations (cloudpathlib paths from BlobPath) upload through the path's BlobServiceClient, so every file shares
+    its connection pool, and record the content's sha256 in blob metadata: files whose hash is unchanged (e.g. a rerun) are skipped.
+    Local destinations are copied, skipping identical files.
+    """
+
+    def __init__(self, path: Union[str, Path] = None, max_workers: int = 4, max_concurrency: int = 4):
+        self.path = Path(path or tempfile.mkdtemp(prefix="kql-uploads-"))
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_concurrency = max_concurrency
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.waiter = ThreadPoolExecutor(thread_name_prefix="kql-upload-wait")  # apart from the upload workers so waits can't starve them
+        self.staged = {}  # buffer folder -> destination folder
+
+    def stage(self, target) -> Path:
+        "A new local buffer folder for files destined for the target folder"
+        buffer = Path(tempfile.mkdtemp(dir=self.path))
+        self.staged[buffer] = target
+        return buffer
+
+    def upload(self, buffer: Path) -> pandas.DataFrame:
+        "Upload a staged folder's files concurrently, returning per file Bytes, Seconds, MBps and Status (uploaded or unchanged)"
+        target = self.staged[buffer]
+        files = sorted(f for f in buffer.iterdir() if f.is_file())
+        results = [future.result() for future in [self.executor.submit(self.upload_file, f, target / f.name) for f in files]]
+        # only discard the buffer once everything is uploaded, so failures can be retried
+        shutil.rmtree(buffer, ignore_errors=True)
+        del self.staged[buffer]
+        return pandas.DataFrame(results, columns=["File", "Bytes", "Seconds", "MBps", "Status"]).set_index("File")
+
+    def submit(self, buffer: Path, after: list[Future] = []) -> Future:
+        "Upload a staged folder once the futures writing it are done, returning a future resolving to upload's stats"
+
+        def upload_after():
+            wait(after)
+            for future in after:
+                future.result()  # don't upload partial output
+            return self.upload(buffer)
+
+        return self.waiter.submit(upload_after)
+
+    def upload_file(self, local: Path, target) -> tuple:
+        start, size, digest = time.perf_counter(), local.stat().st_size, file_hash(local)
+        if isinstance(target, Path):
+            changed = self.copy_file(local, target, digest)
+        else:
+            changed = self.put_blob(local, target, digest)
+        seconds = time.perf_counter() - start
+        return str(target), size, seconds, size / 1e6 / seconds if seconds else None, "uploaded" if changed else "unchanged"
+
+    def copy_file(self, local: Path, target: Path, digest: str) -> bool:
+        if target.is_file() and target.stat().st_size == local.stat().st_size and file_hash(target) == digest:
+            return False
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_write(target) as tmp:
+            shutil.copyfile(local, tmp)
+        return True
+
+    def put_blob(self, local: Path, target, digest: str) -> bool:
+        from azure.core.exceptions import ResourceNotFoundError
+        from azure.storage.blob import ContentSettings
+
+        blob = target.client.service_client.get_blob_client(target.container, target.blob)
+        try:
+            if blob.get_blob_properties().metadata.get("sha256") == digest:
+                return False
+        except ResourceNotFoundError:
+            pass
+        content_type = content_type_for(local)
+        with open(local, "rb") as data:
+            blob.upload_blob(
+                data,
+                length=local.stat().st_size,
+                overwrite=True,
+                max_concurrency=self.max_concurrency,
+                metadata={"sha256": digest},
+                content_settings=ContentSettings(content_type=content_type),
+            )
+        return True
+
+    def shutdown(self, wait: bool = True):
+        self.waiter.shutdown(wait=wait)
+        self.executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+# threads don't survive a fork, so render_fleet workers create their own
+uploader = Singleton(Uploader, "Shared Uploader", close=Uploader.shutdown, per_process=True)
@@ -0,0 +1,54 @@
+import os, threading
+from multiprocessing.util import Finalize
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class Singleton:
+    """
+    A shared instance behind a module level function, e.g. client = Singleton(LogAnalyticsClient, "Shared LogAnalyticsClient").
+    Calling it returns the instance, created on first use (pass kwargs to replace it, close(old instance) is called first).
+    per_process instances are recreated in forked children (with the same kwargs), as the threads they own don't survive a fork,
+    and closed when the process exits (a worker would otherwise wait forever on the processes of a pool it never shut down).
+    """
+
+    def __init__(self, factory, doc: str = "", close=None, per_process: bool = False):
+        self.factory, self.close, self.per_process = factory, close, per_process
+        self.__doc__ = f"{doc}, created on first use (pass kwargs to replace it)"
+        self.instance, self.kwargs, self.pid, self.lock = None, {}, None, threading.Lock()
+
+    def __call__(self, **kwargs):
+        with self.lock:
+            forked = self.per_process and self.pid != os.getpid()
+            if self.instance is None or kwargs or forked:
+                if self.instance is not None and self.close is not None and not forked:
+                    self.close(self.instance)
+                self.kwargs = kwargs or self.kwargs
+                self.instance, self.pid = self.factory(**self.kwargs), os.getpid()
+                if self.per_process and self.close is not None:
+                    # ahead of multiprocessing's own queue finalizers (exitpriority 10), so a pool can still signal its workers
+                    Finalize(self.instance, self.close, args=(self.instance,), exitpriority=100)
+            return self.instance
+
+    def reset(self):
+        "Forget the instance (without closing it) and its kwargs, so the next call creates a default one"
+        with self.lock:
+            self.instance, self.kwargs = None, {}
+
+
+@contextmanager
+def atomic_write(target):
+    """
+    Yields a temporary path beside a local target that is renamed over it once written, so concurrent readers
+    (other agencies' processes, sibling notebooks) never see a partial file. Blob paths are yielded as is, blob uploads only
+    become visible once committed.
+    """
+    if not isinstance(target, Path):
+        yield target
+        return
+    tmp = target.with_name(f".{target.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        yield tmp
+        tmp.replace(target)
+    finally:
+        tmp.unlink(missing_ok=True)
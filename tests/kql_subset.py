@@ -0,0 +1,474 @@
+import json, math, re, pandas
+
+
+# no kusto engine runs offline, so tests check the pushed down kql2df stages by evaluating them over dataframes
+class KQLSubset:
+    """
+    Evaluates the KQL that kql2df stages (KQL.label_size_kql, KQL.rename_and_sort_kql) generate over a dataframe, so stages
+    can be checked offline against their pandas versions: evaluate_kql(df, stage).
+    Covers only the operators and functions those stages use, typed like kusto (strings are never null, coalesce and iff
+    need matching types, count() takes no arguments, prev and row_number need serialized rows); anything else raises ValueError.
+    """
+
+    token = re.compile(
+        r"\s*(?:(?P<string>'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\")|(?P<number>\d+(?:\.\d+)?)|(?P<name>project-away|project-rename|[A-Za-z_][\w.]*)"
+        r"|(?P<op>==|!=|<=|>=|[-|()\[\],=<>*+/%]))"
+    )
+    aggregates = {"sum", "avg", "max", "min", "count", "countif", "percentile"}
+
+    def __init__(self, kql: str, tables: dict):
+        self.tokens, self.pos, self.tables = self.tokenize(kql), 0, tables
+
+    def tokenize(self, kql: str) -> list:
+        tokens, pos, kql = [], 0, kql.rstrip()
+        while pos < len(kql):
+            if kql.startswith("dynamic(", pos):
+                value, end = json.JSONDecoder().raw_decode(kql, pos + len("dynamic("))
+                tokens.append(("dynamic", value))
+                pos = kql.index(")", end) + 1
+                continue
+            match = self.token.match(kql, pos)
+            if not match or match.end() == pos:
+                raise ValueError(f"kql syntax error at {kql[pos:pos + 20]!r}")
+            kind = match.lastgroup
+            text = match.group(kind)
+            if kind == "string":
+                text = re.sub(r"\\(.)", r"\1", text[1:-1])
+            tokens.append((kind, text))
+            pos = match.end()
+        return tokens
+
+    def peek(self, offset: int = 0):
+        return self.tokens[self.pos + offset] if self.pos + offset < len(self.tokens) else (None, None)
+
+    def take(self, expected: str = None):
+        kind, text = self.peek()
+        if kind is None or (expected is not None and text != expected):
+            raise ValueError(f"kql syntax error: expected {expected!r}, got {text!r}")
+        self.pos += 1
+        return kind, text
+
+    def accept(self, text: str) -> bool:
+        if self.peek()[1] == text and self.peek()[0] != "string":
+            self.pos += 1
+            return True
+        return False
+
+    def name(self) -> str:
+        if self.accept("["):
+            kind, text = self.take()
+            self.take("]")
+            if kind != "string":
+                raise ValueError(f"kql syntax error: bracketed name {text!r} should be quoted")
+            return text
+        kind, text = self.take()
+        if kind != "name":
+            raise ValueError(f"kql syntax error: expected a name, got {text!r}")
+        return text
+
+    def names(self) -> list[str]:
+        names = [self.name()]
+        while self.accept(","):
+            names.append(self.name())
+        return names
+
+    def is_assignment(self) -> bool:
+        offset = 3 if self.peek()[1] == "[" else 1
+        return self.peek(offset) == ("op", "=")
+
+    def assignments(self, default=None) -> list:
+        "name = expression pairs (or bare expressions, named by default(expression))"
+        items = []
+        while True:
+            name = self.name() if self.is_assignment() else None
+            if name is not None:
+                self.take("=")
+            expression = self.expression()
+            items.append((name if name is not None else default(expression), expression))
+            if not self.accept(","):
+                return items
+
+    # tabular expressions, evaluated as they are parsed into (dataframe, {column: kind}, serialized)
+    def run(self, source: pandas.DataFrame) -> pandas.DataFrame:
+        table = self.pipeline(self.frame(source)) if self.peek()[1] == "|" else self.tabular()
+        if self.pos != len(self.tokens):
+            raise ValueError(f"kql syntax error: unexpected {self.peek()[1]!r}")
+        return table[0]
+
+    def frame(self, df: pandas.DataFrame):
+        kinds = {}
+        for column, dtype in df.dtypes.items():
+            if pandas.api.types.is_bool_dtype(dtype):
+                kinds[column] = "bool"
+            elif pandas.api.types.is_integer_dtype(dtype):
+                kinds[column] = "long"
+            elif pandas.api.types.is_float_dtype(dtype):
+                kinds[column] = "real"
+            elif pandas.api.types.is_datetime64_any_dtype(dtype):
+                kinds[column] = "datetime"
+            else:
+                kinds[column] = "string"
+                df = df.assign(**{column: df[column].fillna("").astype(str)})
+        return df.reset_index(drop=True), kinds, False
+
+    def tabular(self):
+        name = self.name()
+        if name not in self.tables:
+            raise ValueError(f"unknown table {name}")
+        return self.pipeline(self.tables[name])
+
+    def subquery(self):
+        self.take("(")
+        table = self.tabular()
+        self.take(")")
+        return table
+
+    def pipeline(self, table):
+        while self.accept("|"):
+            kind, operator = self.take()
+            if operator == "order":
+                self.take("by")
+                operator = "order by"
+            method = getattr(self, "op_" + operator.replace("-", "_").replace(" ", "_"), None)
+            if kind != "name" or method is None:
+                raise ValueError(f"unsupported kql operator {operator}")
+            table = method(table)
+        return table
+
+    def op_as(self, table):
+        if self.accept("hint.materialized"):
+            self.take("=")
+            self.take("true")
+        self.tables[self.name()] = table
+        return table
+
+    def op_where(self, table):
+        df, kinds, serialized = table
+        values, kind = self.evaluate(self.expression(), table)
+        if kind != "bool":
+            raise ValueError("where needs a bool predicate")
+        return df[values.fillna(False).astype(bool)].reset_index(drop=True), kinds, serialized
+
+    def op_extend(self, table, items=None):
+        df, kinds, serialized = table
+        df, kinds = df.copy(), dict(kinds)
+        for name, expression in items or self.assignments(self.default_name):
+            df[name], kinds[name] = self.evaluate(expression, (df, kinds, serialized))
+        return df, kinds, serialized
+
+    def op_project(self, table):
+        items = self.assignments(self.default_name)
+        df, kinds, serialized = self.op_extend(table, [(name, e) for name, e in items if e != ("column", name)])
+        columns = [name for name, _ in items]
+        return df[columns], {c: kinds[c] for c in columns}, serialized
+
+    def op_project_away(self, table):
+        df, kinds, serialized = table
+        columns = self.names()
+        self.check_columns(columns, kinds)
+        return df.drop(columns=columns), {c: k for c, k in kinds.items() if c not in columns}, serialized
+
+    def op_project_rename(self, table):
+        df, kinds, serialized = table
+        renames = {}
+        for name, expression in self.assignments():
+            if expression[0] != "column":
+                raise ValueError("project-rename needs new = old column pairs")
+            renames[expression[1]] = name
+        self.check_columns(list(renames), kinds)
+        return df.rename(columns=renames), {renames.get(c, c): k for c, k in kinds.items()}, serialized
+
+    def op_order_by(self, table):
+        columns, ascending = [self.name()], [self.ascending()]
+        while self.accept(","):
+            columns.append(self.name())
+            ascending.append(self.ascending())
+        return self.sort(table, columns, ascending)
+
+    def op_top(self, table):
+        count = int(self.take()[1])
+        self.take("by")
+        df, kinds, _ = self.sort(table, [self.name()], [self.ascending()])
+        return df.head(count), kinds, False
+
+    def ascending(self) -> bool:
+        "kusto sorts descending unless asc is given"
+        if self.accept("asc"):
+            return True
+        self.accept("desc")
+        return False
+
+    def sort(self, table, columns: list, ascending: list):
+        df, kinds, _ = table
+        self.check_columns(columns, kinds)
+        return df.sort_values(columns, ascending=ascending, kind="stable").reset_index(drop=True), kinds, True
+
+    def op_summarize(self, table):
+        df, kinds, _ = table
+        items = self.assignments(self.default_name)
+        keys = self.names() if self.accept("by") else []
+        self.check_columns(keys, kinds)
+        data, out_kinds, reducers = df[keys].copy(), {key: kinds[key] for key in keys}, {}
+        for n, (name, expression) in enumerate(items):
+            data[f"_{n}"], out_kinds[name], reducers[name] = self.aggregate(expression, table)
+        if keys:
+            groups = data.groupby(keys, sort=False, dropna=False)
+            result = pandas.DataFrame({name: groups[f"_{n}"].agg(reducers[name]) for n, name in enumerate(reducers)}).reset_index()
+        else:
+            result = pandas.DataFrame({name: [reducers[name](data[f"_{n}"])] for n, name in enumerate(reducers)})
+        return result, out_kinds, False
+
+    def op_lookup(self, table, join=False):
+        how = "left"
+        if self.accept("kind"):
+            self.take("=")
+            how = {"leftouter": "left", "inner": "inner"}[self.take()[1]]
+        elif join:
+            raise ValueError("join needs an explicit kind (the default, innerunique, is not supported)")
+        right, right_kinds, _ = self.subquery()
+        self.take("on")
+        keys = self.names()
+        df, kinds, _ = table
+        self.check_columns(keys, kinds)
+        self.check_columns(keys, right_kinds)
+        extra = [column for column in right.columns if join or column not in keys]
+        clashes = [column for column in extra if column in kinds]
+        if clashes and not join:
+            raise ValueError(f"lookup columns {clashes} are already in the left table")
+        renames = {column: f"{column}1" for column in clashes}
+        right = right[(keys if not join else []) + extra].rename(columns=renames)
+        right_on = [renames.get(key, key) for key in keys]
+        merged = df.merge(right, how=how, left_on=keys, right_on=right_on, sort=False)
+        merged_kinds = dict(kinds, **{renames.get(c, c): right_kinds[c] for c in extra})
+        for column in merged.columns:
+            if merged_kinds[column] == "string":
+                merged[column] = merged[column].fillna("")
+        return merged[list(merged_kinds)], merged_kinds, False
+
+    def op_join(self, table):
+        return self.op_lookup(table, join=True)
+
+    def op_evaluate(self, table):
+        plugin = self.name()
+        self.take("(")
+        df, kinds, _ = table
+        if plugin == "narrow":
+            self.take(")")
+            cells = [
+                (row, column, "" if pandas.isna(value) else self.to_string(value, kinds[column]))
+                for row, values in enumerate(df.itertuples(index=False))
+                for column, value in zip(df.columns, values)
+            ]
+            return pandas.DataFrame(cells, columns=["Row", "Column", "Value"]), {"Row": "long", "Column": "string", "Value": "string"}, False
+        if plugin == "pivot":
+            column = self.name()
+            self.take(",")
+            values, kind, reducer = self.aggregate(self.expression(), table)
+            keys = self.names() if self.accept(",") else []
+            self.take(")")
+            self.check_columns([column] + keys, kinds)
+            data = df[keys + [column]].assign(_value=values)
+            pivoted = data.groupby(keys + [column], sort=False)["_value"].agg(reducer).unstack(column).reset_index()
+            pivoted.columns = [str(c) for c in pivoted.columns]
+            return pivoted, dict({key: kinds[key] for key in keys}, **{str(c): kind for c in pivoted.columns[len(keys) :]}), False
+        raise ValueError(f"unsupported kql plugin {plugin}")
+
+    def check_columns(self, columns: list, kinds: dict):
+        missing = [column for column in columns if column not in kinds]
+        if missing:
+            raise ValueError(f"unknown columns {missing}")
+
+    # scalar expressions, parsed to tuples then evaluated per table
+    def expression(self):
+        left = self.conjunction()
+        while self.accept("or"):
+            left = ("binary", "or", left, self.conjunction())
+        return left
+
+    def conjunction(self):
+        left = self.comparison()
+        while self.accept("and"):
+            left = ("binary", "and", left, self.comparison())
+        return left
+
+    def comparison(self):
+        left = self.additive()
+        if self.peek() in [("op", op) for op in ("==", "!=", "<", ">", "<=", ">=")]:
+            left = ("binary", self.take()[1], left, self.additive())
+        return left
+
+    def additive(self):
+        left = self.multiplicative()
+        while self.peek() in [("op", "+"), ("op", "-")]:
+            left = ("binary", self.take()[1], left, self.multiplicative())
+        return left
+
+    def multiplicative(self):
+        left = self.postfix()
+        while self.peek() in [("op", "*"), ("op", "/"), ("op", "%")]:
+            left = ("binary", self.take()[1], left, self.postfix())
+        return left
+
+    def postfix(self):
+        value = self.primary()
+        while self.accept("["):
+            value = ("index", value, self.expression())
+            self.take("]")
+        return value
+
+    def primary(self):
+        kind, text = self.peek()
+        if kind == "number":
+            self.take()
+            return ("literal", float(text), "real") if "." in text else ("literal", int(text), "long")
+        if kind == "string":
+            self.take()
+            return ("literal", text, "string")
+        if kind == "dynamic":
+            self.take()
+            return ("literal", text, "dynamic")
+        if text in ("true", "false") and kind == "name":
+            self.take()
+            return ("literal", text == "true", "bool")
+        if self.accept("("):
+            value = self.expression()
+            self.take(")")
+            return value
+        if kind == "name" and self.peek(1) == ("op", "("):
+            self.take()
+            if text == "toscalar":
+                df, kinds, _ = self.subquery()
+                return ("literal", df.iloc[0, 0] if len(df) else None, kinds[df.columns[0]])
+            self.take("(")
+            arguments = []
+            if not self.accept(")"):
+                arguments = [self.expression()]
+                while self.accept(","):
+                    arguments.append(self.expression())
+                self.take(")")
+            return ("call", text, arguments)
+        return ("column", self.name())
+
+    def default_name(self, expression) -> str:
+        if expression[0] == "column":
+            return expression[1]
+        if expression[0] == "call":
+            columns = [str(a[1]) for a in expression[2] if a[0] in ("column", "literal")]
+            return "_".join([expression[1]] + columns) if expression[1] != "count" else "count_"
+        raise ValueError("kql expressions need a column name")
+
+    def aggregate(self, expression, table):
+        "(per row values, result kind, reducer) for an aggregation call"
+        if expression[0] != "call" or expression[1] not in self.aggregates:
+            raise ValueError(f"expected an aggregation, got {expression}")
+        _, function, arguments = expression
+        df = table[0]
+        if function == "count":
+            if arguments:
+                raise ValueError("count() takes no arguments, use countif(isnotempty(column)) to count values")
+            return pandas.Series(1, index=df.index), "long", "sum"
+        values, kind = self.evaluate(arguments[0], table)
+        if function == "countif":
+            if kind != "bool" or len(arguments) != 1:
+                raise ValueError("countif needs a single bool predicate")
+            return values.fillna(False).astype(int), "long", "sum"
+        if kind not in ("long", "real"):
+            raise ValueError(f"{function} needs a numeric argument, got {kind}")
+        if function == "percentile":
+            percent = arguments[1][1]
+            # kusto percentiles are nearest rank, not interpolated
+            return values, kind, lambda v: v.dropna().sort_values().iloc[max(math.ceil(percent / 100 * v.count()) - 1, 0)]
+        if len(arguments) != 1:
+            raise ValueError(f"{function} takes one argument")
+        return values, "real" if function == "avg" else kind, {"avg": "mean"}.get(function, function)
+
+    def evaluate(self, expression, table):
+        "(values, kind) of a scalar expression over a table's rows"
+        df, kinds, serialized = table
+        if expression[0] == "literal":
+            return pandas.Series([expression[1]] * len(df), index=df.index, dtype=object if expression[2] == "dynamic" else None), expression[2]
+        if expression[0] == "column":
+            self.check_columns([expression[1]], kinds)
+            return df[expression[1]], kinds[expression[1]]
+        if expression[0] == "index":
+            base, kind = self.evaluate(expression[1], table)
+            key, key_kind = self.evaluate(expression[2], table)
+            if kind != "dynamic":
+                raise ValueError("only dynamic values can be indexed")
+            return pandas.Series([b.get(k) if isinstance(b, dict) else None for b, k in zip(base, key)], index=df.index, dtype=object), "dynamic"
+        if expression[0] == "binary":
+            return self.binary(expression[1], self.evaluate(expression[2], table), self.evaluate(expression[3], table))
+        _, function, arguments = expression
+        if function in self.aggregates:
+            raise ValueError(f"aggregation {function} outside summarize")
+        values = [self.evaluate(argument, table) for argument in arguments]
+        if function in ("prev", "row_number") and not serialized:
+            raise ValueError(f"{function} needs serialized rows (e.g. after order by)")
+        if function == "prev":
+            return values[0][0].shift(1), values[0][1]
+        if function == "row_number":
+            start = values[0][0].iloc[0] if values else 1
+            restart = values[1][0].fillna(False).astype(bool) if len(values) > 1 else pandas.Series(False, index=df.index)
+            group = restart.cumsum()
+            return group.groupby(group).cumcount() + start, "long"
+        if function == "tostring":
+            series, kind = values[0]
+            return series.map(lambda v: "" if v is None or (not isinstance(v, (dict, list)) and pandas.isna(v)) else self.to_string(v, kind)), "string"
+        if function == "todouble":
+            series, kind = values[0]
+            if kind not in ("string", "long", "real", "bool"):
+                raise ValueError(f"todouble of {kind}")
+            return pandas.to_numeric(series.replace("", None) if kind == "string" else series, errors="coerce").astype(float), "real"
+        if function == "isnotempty":
+            series, kind = values[0]
+            return (series != "") if kind == "string" else series.map(lambda v: v is not None and v == v and v != ""), "bool"
+        if function == "strcat":
+            strings = [self.evaluate(("call", "tostring", [argument]), table)[0] for argument in arguments]
+            return pandas.concat(strings, axis=1).astype(str).agg("".join, axis=1), "string"
+        if function == "coalesce":
+            kinds_ = {kind for _, kind in values}
+            if len(kinds_) != 1:
+                raise ValueError(f"coalesce arguments must all be the same type, got {sorted(kinds_)}")
+            result = values[0][0]
+            for series, kind in values[1:]:
+                empty = (result == "") if kind == "string" else result.isna()
+                result = result.where(~empty, series)
+            return result, values[0][1]
+        if function == "iff":
+            (condition, condition_kind), (then, then_kind), (otherwise, otherwise_kind) = values
+            if condition_kind != "bool" or then_kind != otherwise_kind:
+                raise ValueError("iff needs a bool condition and results of the same type")
+            return then.where(condition.fillna(False).astype(bool), otherwise), then_kind
+        raise ValueError(f"unsupported kql function {function}")
+
+    def binary(self, op: str, left, right):
+        (a, a_kind), (b, b_kind) = left, right
+        numeric = {"long", "real"}
+        if op in ("and", "or"):
+            if a_kind != "bool" or b_kind != "bool":
+                raise ValueError(f"{op} needs bool operands")
+            return (a & b if op == "and" else a | b), "bool"
+        if a_kind != b_kind and not (a_kind in numeric and b_kind in numeric):
+            raise ValueError(f"can't compare or combine {a_kind} and {b_kind}")
+        if op in ("+", "-", "*", "/", "%"):
+            if a_kind not in numeric:
+                raise ValueError(f"{op} needs numeric operands")
+            values = {"+": a + b, "-": a - b, "*": a * b, "/": a / b, "%": a % b}[op]
+            return values, "real" if "real" in (a_kind, b_kind) else "long"
+        return {"==": a == b, "!=": a != b, "<": a < b, ">": a > b, "<=": a <= b, ">=": a >= b}[op], "bool"
+
+    def to_string(self, value, kind: str) -> str:
+        if kind == "bool":
+            return "true" if value else "false"
+        if kind == "long":
+            return str(int(value))
+        if kind == "real":
+            return repr(float(value)).removesuffix(".0")
+        if kind == "dynamic" and not isinstance(value, str):
+            return json.dumps(value)
+        return str(value)
+
+
+def evaluate_kql(df: pandas.DataFrame, kql: str) -> pandas.DataFrame:
+    "Run a kql2df stage (a pipeline starting with |) over df with KQLSubset"
+    return KQLSubset(kql, {}).run(df)
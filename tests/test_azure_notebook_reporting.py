@@ -1,14 +1,771 @@
-from azure_notebook_reporting import azcli, KQL, BlobPath
+import json, os, re, signal, threading, time, zipfile, pandas, pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from azure.core.credentials import AccessToken
+from pathlib import Path
+from azure_notebook_reporting import azcli, KQL, BlobPath, SharedStore, SimulatedBackend, Uploader, loganalytics, rendering
+from azure_notebook_reporting import azure_notebook_reporting
 from azure_notebook_reporting.azure_notebook_reporting import cache
+from azure_notebook_reporting.resultcache import ResultCache
+from azure_notebook_reporting.rendering import RenderPool
+from azure_notebook_reporting.history import HistoryStore
+from azure_notebook_reporting.util import Singleton, atomic_write
+from kql_subset import evaluate_kql
+
+# canned log analytics api response, shaped like the rest api's tables output
+api_response = {
+    "tables": [
+        {
+            "name": "PrimaryResult",
+            "columns": [
+                {"name": "TimeGenerated", "type": "datetime"},
+                {"name": "Table", "type": "string"},
+                {"name": "IngestionVolume", "type": "real"},
+                {"name": "Count", "type": "long"},
+                {"name": "IsBillable", "type": "bool"},
+            ],
+            "rows": [
+                ["2022-10-01T00:00:00Z", "LogManagement: SigninLogs", 1.5, 10, True],
+                ["2022-10-01T01:00:00Z", "LogManagement: Usage", 0.25, 3, False],
+            ],
+        }
+    ]
+}
+
+
+class StubAPI(BaseHTTPRequestHandler):
+    requests = []
+    failures = []  # (status, headers) to respond with before succeeding
+    max_workspaces = 20  # larger requests time out (504)
+
+    def respond(self, status, payload=b"{}", headers={}):
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        StubAPI.requests.append((self.path, self.headers["Authorization"], body))
+        workspaces = [self.path.split("/")[-2]] + body.get("workspaces", [])
+        if StubAPI.failures:
+            return self.respond(*StubAPI.failures.pop(0))
+        if len(workspaces) > StubAPI.max_workspaces:
+            return self.respond(504)
+        # return the canned rows once per queried workspace, tagged with TenantId
+        table = dict(api_response["tables"][0])
+        table["columns"] = table["columns"] + [{"name": "TenantId", "type": "string"}]
+        table["rows"] = [row + [ws] for ws in workspaces for row in table["rows"]]
+        self.respond(200, json.dumps({"tables": [table]}).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class StubCredential:
+    calls = 0
+
+    def get_token(self, *scopes):
+        StubCredential.calls += 1
+        return AccessToken("stub-token", int(time.time()) + 3600)
+
+
+class EmulatedBlobService:
+    "In memory stand in for a BlobServiceClient (like azurite), enough for uploads.Uploader"
+
+    def __init__(self):
+        self.blobs, self.puts = {}, 0
+
+    def get_blob_client(self, container, blob):
+        return EmulatedBlob(self, (container, blob))
+
+
+class EmulatedBlob:
+    def __init__(self, service, key):
+        self.service, self.key = service, key
+
+    def get_blob_properties(self):
+        from azure.core.exceptions import ResourceNotFoundError
+
+        if self.key not in self.service.blobs:
+            raise ResourceNotFoundError("BlobNotFound")
+        return type("BlobProperties", (), {"metadata": self.service.blobs[self.key][1]})
+
+    def upload_blob(self, data, length=None, overwrite=False, max_concurrency=1, metadata=None, content_settings=None):
+        self.service.puts += 1
+        self.service.blobs[self.key] = (data.read(), metadata or {}, content_settings)
+
+
+def render(kp):
+    return kp.agency, kp.querystats["Rows"].to_dict()
+
+
+def render_queries(kp):
+    "A render callback that queries and draws figures with the worker's shared scheduler and render pool"
+    df = kp.kql2df("Usage")
+    figures = kp.figures({"usage": (df.groupby("TenantId")[["Count"]].sum(), {"kind": "barh"})})
+    return len(df), figures["usage"].content.getvalue()[:4]
+
+
+def timeout(signum, frame):
+    raise TimeoutError
+
+
+def fleet_path(tmp_path):
+    lists = tmp_path / "notebooks" / "lists"
+    lists.mkdir(parents=True)
+    workspaces = [{"customerId": f"ws{i}", "SecOps Group": f"agency{i % 3}"} for i in range(45)]
+    pandas.DataFrame(workspaces).to_csv(lists / "SentinelWorkspaces.csv", index=False)
+    groups = [{"Alias": f"agency{i}", "Primary agency": f"Agency {i}"} for i in range(4)]
+    pandas.DataFrame(groups).to_csv(lists / "SecOps Groups.csv", index=False)
+    return tmp_path
+
+
+@pytest.fixture(autouse=True)
+def shared_state():
+    "Each test starts and ends with no shared client, scheduler or telemetry"
+    shared = (loganalytics.client, loganalytics.scheduler, loganalytics.telemetry)
+    for singleton in shared:
+        singleton.reset()
+    yield
+    for singleton in shared:
+        singleton.reset()
+
+
+@pytest.fixture
+def api():
+    "A stub log analytics api server, with the shared client pointed at it"
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    StubAPI.requests.clear()
+    StubCredential.calls = 0
+    loganalytics.client(endpoint=f"http://127.0.0.1:{server.server_port}/v1", credential=StubCredential())
+    yield server
+    StubAPI.failures, StubAPI.max_workspaces = [], 20
+    server.shutdown()
+
 
 class TestClass:
     def test_kql(self):
         kp = KQL(BlobPath("."))
         assert isinstance(kp.sentinelworkspaces, list)
-    
+
     def test_azcli(self):
         assert "azure-cli" in azcli(["version"])
 
     def test_cache(self):
         cache.set("hello", "world")
         assert cache.get("hello") == "world"
+
+    def test_api_query(self, api):
+        workspaces = [f"ws{i}" for i in range(25)]
+        df = KQL.analytics_query(workspaces=workspaces, query="Usage", timespan="P30D")
+        assert len(df) == 50 and len(StubAPI.requests) == 2
+        assert str(df["TimeGenerated"].dtype) == "datetime64[ns, UTC]"
+        assert str(df["Count"].dtype) == "Int64" and str(df["IsBillable"].dtype) == "boolean"
+        assert (df["TableName"] == "PrimaryResult").all()
+        paths = sorted(path for path, auth, body in StubAPI.requests)
+        assert paths == ["/v1/workspaces/ws0/query", "/v1/workspaces/ws20/query"]
+        assert all(auth == "Bearer stub-token" for path, auth, body in StubAPI.requests)
+        assert StubCredential.calls == 1  # token cached across requests
+
+    def test_result_cache(self, tmp_path):
+        rc = ResultCache(tmp_path, ttl=60, maxsize=10**9)
+        key = ResultCache.key("Usage\n| take 10", ["b", "a"], "P30D")
+        assert key == ResultCache.key("// comment\n  Usage\n\n| take 10  ", ["a", "b"], "P30D")
+        assert key != ResultCache.key("Usage\n| take 10", ["a", "b"], "P7D")
+        assert rc.get(key) is None
+        df = loganalytics.tables2df(api_response)
+        rc.set(key, df)
+        pandas.testing.assert_frame_equal(rc.get(key), df)
+        # expired entries miss
+        os.utime(tmp_path / f"{key}.parquet", (0, 0))
+        assert rc.get(key) is None
+        # least recently used entries are evicted first once over size
+        rc.maxsize = 1
+        for k in ("a", "b"):
+            rc.set(k, df)
+        assert not (tmp_path / "a.parquet").exists() and not (tmp_path / "b.parquet").exists()
+        # room for two entries: reading a makes b the least recently used, so b goes when c is added
+        rc = ResultCache(tmp_path, ttl=60, maxsize=2 * len(df.to_parquet()))
+        evictions = []
+        evict = rc.evict
+        rc.evict = lambda: evictions.append(1) or evict()
+        for k in ("a", "b"):
+            rc.set(k, df)
+            time.sleep(0.02)
+        assert rc.get("a") is not None and len(evictions) == 1  # the store is only listed on the first write while under size
+        time.sleep(0.02)
+        rc.set("c", df)
+        assert len(evictions) == 2 and sorted(p.stem for p in tmp_path.glob("*.parquet")) == ["a", "c"]
+
+    def test_kql2df_cache(self, tmp_path, api):
+        kp = KQL(tmp_path, cache_ttl=60)
+        kp.sentinelworkspaces = ["ws0", "ws1"]
+        StubAPI.requests.clear()
+        first, second = kp.kql2df("Usage"), kp.kql2df("Usage")
+        pandas.testing.assert_frame_equal(first, second)
+        assert len(StubAPI.requests) == 1 and kp.result_cache.hits == 1
+        # results missing a failed chunk are returned but not cached
+        StubAPI.failures = [(400, b"{}", {})]
+        kp.sentinelworkspaces = [f"ws{i}" for i in range(25)]
+        assert len(kp.kql2df("Usage")) in (10, 40) and len(list((tmp_path / "notebooks" / "cache").glob("*.parquet"))) == 1
+
+    def test_fleet(self, tmp_path, api):
+        kp = KQL(fleet_path(tmp_path))
+        StubAPI.requests.clear()
+        queries = {"Fleet": "// fleet: TenantId\nUsage", "Per agency": "Usage"}
+        reports = kp.load_queries_fleet(queries, sample_agency="agency0")
+        # 45 workspaces: fleet query in 3 chunks, per agency query 15 workspaces each in 1 chunk
+        assert len(StubAPI.requests) == 3 + 3
+        assert sorted(reports) == ["agency0", "agency1", "agency2"]
+        for agency, report in reports.items():
+            df = report.queries["Fleet"][1]
+            assert set(df["TenantId"]) == set(report.sentinelworkspaces) and len(df) == 30
+            assert df.index.equals(pandas.RangeIndex(30))  # no stray index column in the excel export
+            assert report.querystats["Rows"]["Per agency"] == 30
+        outputs = KQL.render_fleet(reports, render, max_workers=2)
+        assert outputs["agency1"] == ("agency1", {"Fleet": 30, "Per agency": 30})
+        # sample only reports just query the sample agency's 15 workspaces, one chunk per query
+        StubAPI.requests.clear()
+        reports = kp.load_queries_fleet(queries, sample_agency="agency0", sample_only=True)
+        assert len(StubAPI.requests) == 2 and sorted(reports) == ["agency0", "agency1", "agency2"]
+        assert len(reports["agency1"].queries["Fleet"][1]) == 30 and reports["agency1"].querystats["Rows"]["Fleet"] == 0
+
+    def test_render_fleet_after_parent_use(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(KQL, "backend", SimulatedBackend(rows=5))
+        monkeypatch.setattr(KQL, "figure_memo", {})
+        kp = KQL(fleet_path(tmp_path))
+        reports = kp.load_queries_fleet({"Usage": "Usage"})
+        # the parent's scheduler and render pool are running when render_fleet forks its workers
+        reports["agency0"].figures({"usage": (pandas.DataFrame({"Count": [1, 2]}), {"kind": "barh"})})
+        # workers hang (querying, rendering or exiting) if they inherit the parent's, so fail rather than wait forever
+        handler = signal.signal(signal.SIGALRM, timeout)
+        signal.alarm(120)
+        try:
+            outputs = KQL.render_fleet(reports, render_queries, max_workers=2)
+        finally:
+            signal.alarm(0)
+            signal.signal(signal.SIGALRM, handler)
+            rendering.pool().shutdown()
+            rendering.pool.reset()
+        assert outputs == {agency: (75, b"\x89PNG") for agency in reports}
+
+    def test_shared_store(self, tmp_path, monkeypatch):
+        simulated = SimulatedBackend(rows=5)
+        monkeypatch.setattr(KQL, "backend", lambda chunk, query, timespan: pandas.DataFrame() if query == "Empty" else simulated(chunk, query, timespan))
+        kp = KQL(fleet_path(tmp_path))
+        queries = {"Fleet": "// fleet: TenantId\nUsage", "Missing": "Empty"}
+        reports = kp.load_queries_fleet(queries, sample_agency="agency0")
+        with SharedStore(tmp_path / "shared") as store:
+            outputs = KQL.render_fleet(reports, render, max_workers=2, store=store)
+            assert outputs == {agency: render(kp) for agency, kp in reports.items()}
+            # 3 fleet splits, the sample agency's Missing fallback once, and the workspace table
+            assert len(list(store.path.glob("*.arrow"))) == 3 + 1 + 1
+            # a sibling process attaches by agency
+            attached = KQL(tmp_path).attach_queries(SharedStore(store.path), "agency1")
+            assert attached.queries["Fleet"][1].equals(reports["agency1"].queries["Fleet"][1])
+            assert list(attached.queries) == ["Fleet", "Missing"] and attached.querystats["Rows"].to_dict() == reports["agency1"].querystats["Rows"].to_dict()
+        assert not store.path.exists()
+
+    def test_query_options(self):
+        query = "// fleet: TenantId\n// Split: bin\nUsage\n| take 1"
+        assert KQL.query_options(query) == {"fleet": "TenantId", "split": "bin"}
+        assert KQL.source_table(query) == "Usage"
+
+    def test_report_pdf_async(self, tmp_path):
+        kp = KQL(fleet_path(tmp_path)).set_agency("agency1")
+        kp.report_title = "Test Report"
+        df = loganalytics.tables2df(api_response)
+        kp.collect_queries({"Usage": "usage.kql", "Empty": "empty.kql"}, {"Usage": df, "Empty": KQL.no_data_df("Usage", "P30D")})
+        background = tmp_path / "background.svg"
+        background.write_text("<svg xmlns='http://www.w3.org/2000/svg'/>")
+        rp = kp.init_report(background=background, entity="Agency 1", date="October 2022", body="#222", links="#333", titles="#444", footer="#555")
+        rp["Usage"] = "Ingestion"
+        rp["Usage"] += df.head()
+        with RenderPool(max_workers=2, max_pending=2) as pool:
+            futures = kp.report_pdf_async(savehtml=True, folders=True, pool=pool)
+            assert futures["html"].result().read_text().count("Ingestion") > 0
+            workbook = zipfile.ZipFile(futures["xlsx"].result()).read("xl/workbook.xml").decode()
+        assert re.findall(r'sheet name="([^"]+)"', workbook) == ["Query Stats", "Usage", "Empty"]
+        assert str(df["TimeGenerated"].dtype) == "datetime64[ns, UTC]"
+
+    def test_figures(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(KQL, "figure_memo", {})
+        kp = KQL(tmp_path)
+        df = pandas.DataFrame({"Count": [3, 1, 2]}, index=["a", "b", "c"])
+        specs = {"bars": (df, {"kind": "barh"}), "same": (df.copy(), {"kind": "barh"}), "area": (df, {"kind": "area", "title": "Area"})}
+        with RenderPool(max_workers=2) as pool:
+            figures = kp.figures(specs, pool=pool)
+        assert len(KQL.figure_memo) == 2 and len(list((tmp_path / "notebooks" / "cache" / "figures").glob("*.png"))) == 2
+        assert figures["bars"].content.getvalue().startswith(b"\x89PNG")
+        # a new process (empty memo) reuses the rendered files without a pool
+        monkeypatch.setattr(KQL, "figure_memo", {})
+        monkeypatch.setattr(azure_notebook_reporting.rendering, "pool", None)
+        assert kp.figures(specs)["area"].content.getvalue() == figures["area"].content.getvalue()
+        # the disk cache expires like the result cache, so it doesn't grow without bound
+        figure_dir = tmp_path / "notebooks" / "cache" / "figures"
+        for figure in figure_dir.glob("*.png"):
+            os.utime(figure, (0, 0))
+        kp.figure_cache("png").evict()
+        assert not list(figure_dir.iterdir())
+
+    def test_uploader(self, tmp_path, monkeypatch):
+        from cloudpathlib import AzureBlobClient
+
+        service = EmulatedBlobService()
+        target = AzureBlobClient(blob_service_client=service).CloudPath("az://reports/agency1")
+        with Uploader(tmp_path / "buffer", max_workers=2) as uploader:
+            for content in ["v1", "v1", "v2"]:
+                buffer = uploader.stage(target)
+                (buffer / "report.pdf").write_text("pdf")
+                (buffer / "report.xlsx").write_text(content)
+                stats = uploader.upload(buffer)
+            assert stats["Status"].to_dict() == {"az://reports/agency1/report.pdf": "unchanged", "az://reports/agency1/report.xlsx": "uploaded"}
+            assert service.puts == 3 and service.blobs[("reports", "agency1/report.xlsx")][0] == b"v2" and not buffer.exists()
+            # archives keep their type and are never marked Content-Encoding: gzip (downloads would be decompressed)
+            buffer = uploader.stage(target)
+            (buffer / "report.csv.gz").write_bytes(b"gz")
+            uploader.upload(buffer)
+            settings = service.blobs[("reports", "agency1/report.csv.gz")][2]
+            assert settings.content_type == "application/gzip" and not settings.content_encoding
+            # local reports are only staged if an uploader is given
+            kp = KQL(fleet_path(tmp_path)).set_agency("agency1")
+            kp.report_title = "Test Report"
+            kp.report_files()
+            assert kp.staged_files()[1] is None
+            _, buffer, pdf_file, _ = kp.staged_files(uploader)
+            pdf_file.write_text("pdf")
+            assert uploader.upload(buffer)["Bytes"].to_dict() == {str(kp.pdf_file): 3} and kp.pdf_file.read_text() == "pdf"
+        # one sas per container
+        calls = []
+        monkeypatch.setattr(azure_notebook_reporting, "blob_clients", {})
+        monkeypatch.setattr(azure_notebook_reporting, "azcli", lambda cmd: calls.append(cmd) or "sv=2021&sig=stub")
+        first, second = BlobPath("https://account.blob.core.windows.net/reports", "sub"), BlobPath("https://account.blob.core.windows.net/reports", "sub")
+        assert len(calls) == 1 and first.client is second.client
+        # other containers don't replace the default client pickled report paths are restored with, a report does
+        monkeypatch.setattr(AzureBlobClient, "_default_client", None)
+        other = BlobPath("https://account.blob.core.windows.net/other", "sub")
+        assert len(calls) == 2 and other.client is not first.client and AzureBlobClient._default_client is None
+        assert KQL(first).path.client is AzureBlobClient._default_client
+
+    def test_write_excel(self, tmp_path):
+        df = pandas.DataFrame(
+            {"TimeGenerated": pandas.date_range("2022-10-01", periods=100, freq="H", tz="UTC"), "Count": range(100), "TableName": "PrimaryResult"}
+        )
+        df["Details"] = [{"n": i} if i % 2 else None for i in range(100)]
+        stats = pandas.DataFrame({"Rows": [100]}, index=pandas.Index(["Usage"], name="Query"))
+        excel_file = rendering.write_excel({"Query Stats": stats, "Usage": df}, tmp_path / "report.xlsx", max_rows=10, sample=True, bulk="parquet")
+        assert str(df["TimeGenerated"].dtype) == "datetime64[ns, UTC]" and "TableName" in df.columns
+        workbook = zipfile.ZipFile(excel_file)
+        assert 'ref="A1:B2"' in workbook.read("xl/worksheets/sheet1.xml").decode()
+        assert 'ref="A1:C11"' in workbook.read("xl/worksheets/sheet2.xml").decode()
+        bulk = pandas.read_parquet(tmp_path / "report-Usage.parquet")
+        assert len(bulk) == 100 and "TableName" not in bulk.columns
+        # rerunning a report writes identical files (no timestamps), so uploads skip them
+        with Uploader(tmp_path / "buffer") as uploader:
+            for rerun in range(2):
+                buffer = uploader.stage(tmp_path / "uploaded")
+                rendering.write_excel({"Query Stats": stats, "Usage": df}, buffer / "report.xlsx", bulk="csv.gz")
+                stats_by_file = uploader.upload(buffer)["Status"]
+                time.sleep(1.1 * (not rerun))  # xlsxwriter and gzip timestamps have second resolution
+        assert set(stats_by_file) == {"unchanged"} and len(stats_by_file) == 3
+
+    def test_telemetry(self, tmp_path, api):
+        loganalytics.scheduler(max_inflight=2, backoff=0.01)
+        loganalytics.telemetry(trace=tmp_path / "trace.jsonl")
+        StubAPI.failures = [(429, b"{}", {"Retry-After": "0.01"})]
+        kp = KQL(fleet_path(tmp_path)).set_agency("agency1")
+        kp.collect_queries({"Usage": "Usage"}, {"Usage": kp.kql2df("Usage", workspaces=kp.sentinelworkspaces[:2])})
+        events = kp.telemetry()
+        chunks = events[events["stage"] == "chunk"]
+        assert list(chunks["error"]) == ["throttled", ""] and list(chunks["attempt"]) == [0, 1]
+        assert chunks["bytes"].iloc[1] > 0 and chunks["workspace_rows"].iloc[1] == {"ws1": 2, "ws4": 2}
+        assert events[events["stage"] == "query"]["source"].tolist() == ["query"]
+        stats = kp.querystats.to_dict()
+        assert stats["Requests"]["Usage"] == 2 and stats["Retries"]["Usage"] == 1 and stats["Errors"]["Usage"] == "throttled"
+        assert len((tmp_path / "trace.jsonl").read_text().splitlines()) == 3
+        assert list(kp.excel_sheets()) == ["Query Stats", "Usage", "Telemetry"]
+        # another agency's report doesn't see these events
+        assert KQL(fleet_path(tmp_path / "other")).set_agency("agency0").telemetry().empty
+
+    def test_telemetry_per_agency(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(KQL, "backend", SimulatedBackend(rows=2))
+        queries = {
+            "Usage": "// fleet: TenantId\nUsage | summarize IngestionVolume = sum(Quantity) by Table, TenantId",
+            "Alerts": "SecurityAlert | summarize LastAlert = max(TimeGenerated) by TenantId",
+        }
+        reports = KQL(fleet_path(tmp_path)).load_queries_fleet(queries, sample_agency="agency0")
+        kp = reports["agency1"]
+        kp.report_title = "Test Report"
+        kp.report_files()
+        rendering.write_excel(kp.excel_sheets(), kp.excel_file)
+        # 45 workspaces in 3 chunks of fleet wide queries, each mixing all three agencies' workspaces
+        xlsx = zipfile.ZipFile(kp.excel_file)
+        workspaces = set(re.findall(r"\bws\d+\b", " ".join(xlsx.read(name).decode() for name in xlsx.namelist())))
+        assert workspaces and workspaces <= set(kp.sentinelworkspaces)
+        events = kp.telemetry()
+        assert (events["stage"] == "chunk").any() and events["workspaces"].map(set(kp.sentinelworkspaces).issuperset).all()
+        # rerunning the queries in the same kernel only counts the new run's requests
+        kp = KQL(fleet_path(tmp_path / "rerun")).set_agency("agency1")
+        for rerun in range(2):
+            kp.load_queries(dict(queries))
+            assert kp.querystats["Requests"].to_dict() == {"Usage": 1, "Alerts": 1} and len(kp.excel_sheets()["Telemetry"]) == 4
+
+    def test_simulated_backend(self, monkeypatch):
+        monkeypatch.setattr(KQL, "backend", SimulatedBackend(failure_rate=0.3, rows=5, max_workspaces=8, seed=1))
+        scheduler = loganalytics.scheduler(backoff=0.001)
+        query = (Path(__file__).parent.parent / "notebooks" / "kql" / "siemhealth" / "usage.kql").read_text()
+        df = KQL.analytics_query(workspaces=[f"ws{i}" for i in range(20)], query=query, timespan="P30D")
+        assert list(df.columns) == ["Table", "TimeGenerated", "TenantId", "IngestionVolume", "TableName"]
+        assert len(df) == 100 and df["TenantId"].nunique() == 20
+        assert str(df["TimeGenerated"].dtype) == "datetime64[ns, UTC]" and str(df["IngestionVolume"].dtype) == "Float64"
+        # 20 -> 2 x 10 -> 4 x 5 workspaces, plus a retry per simulated failure
+        assert scheduler.counters["splits"] == 3 and scheduler.counters["requests"] == 7 + scheduler.counters["retries"]
+        # failed chunks are left out, or raised when strict
+        monkeypatch.setattr(KQL, "backend", SimulatedBackend(failure_rate=1.0))
+        assert KQL.no_data(KQL.analytics_query(workspaces=["ws0"], query=query, timespan="P30D"))
+        with pytest.raises(loganalytics.QueryError):
+            KQL.analytics_query(workspaces=["ws0"], query=query, timespan="P30D", strict=True)
+
+    def test_query_bundles(self, tmp_path, monkeypatch):
+        backend = SimulatedBackend(rows=3)
+        monkeypatch.setattr(KQL, "backend", backend)
+        apps = "// bundle: signins\nSigninLogs\n| summarize Signins = count() by AppDisplayName"
+        queries = {
+            "Legacy": "// bundle: signins\nSigninLogs\n| summarize Logins = count() by ClientAppUsed // trailing comment",
+            "Apps": apps,
+            "Same apps": apps.replace("\n|", "\n\n    |"),
+            "Usage": "Usage | summarize IngestionVolume = sum(Quantity) by Table",
+        }
+        kp = KQL(fleet_path(tmp_path)).set_agency("agency1")
+        kp.load_queries(dict(queries))
+        # one bundle for the signin queries (the identical Apps queries run once) and one usage query
+        assert backend.requests == 2 and kp.queries["Apps"][1] is kp.queries["Same apps"][1]
+        assert "ClientAppUsed" in kp.queries["Legacy"][1] and "AppDisplayName" in kp.queries["Apps"][1] and len(kp.queries["Apps"][1]) == 45
+        assert kp.querystats["Source"].to_dict() == {"Legacy": "bundle", "Apps": "bundle", "Same apps": "duplicate", "Usage": "query"}
+        bundle = KQL.bundle_kql([queries["Legacy"], apps])
+        assert bundle.startswith("let _source = materialize(SigninLogs);\n") and "trailing comment\n;\n" in bundle and bundle.count("_source\n|") == 2
+        # backends without multiple result tables run bundled queries one by one
+        monkeypatch.setattr(KQL, "backend", lambda chunk, query, timespan: backend(chunk, query, timespan))
+        kp.load_queries(dict(queries))
+        assert backend.requests == 5
+
+    def test_query_bundle_materialize_cap(self, tmp_path, monkeypatch):
+        queries = {
+            "Incidents": "// bundle: incidents\nSecurityIncident\n| summarize arg_max(TimeGenerated, *) by IncidentNumber, TenantId",
+            "Daily": "// bundle: incidents\nSecurityIncident\n| summarize Count = count() by bin(TimeGenerated, 1d), TenantId",
+        }
+        # 3 rows per workspace: chunks are split down to 3 workspaces to fit under the cap, or run per query if one workspace is over it
+        for cap, requests in [(10, 13), (2, 29 + 15 * 2)]:
+            backend = SimulatedBackend(rows=3, materialize_rows=cap)
+            monkeypatch.setattr(KQL, "backend", backend)
+            loganalytics.scheduler(backoff=0.001)
+            kp = KQL(fleet_path(tmp_path / str(cap))).set_agency("agency1")
+            kp.load_queries(dict(queries))
+            assert backend.requests == requests
+            assert len(kp.queries["Incidents"][1]) == 45 and "IncidentNumber" in kp.queries["Incidents"][1]
+            assert len(kp.queries["Daily"][1]) == 45 and "Count" in kp.queries["Daily"][1]
+
+    def test_label_size(self):
+        df = pandas.DataFrame({"Table": ["a", "b", "c", "d", "e", None] * 2, "GB": [1000, 900, 1, 2, 3, 5] * 2})
+        labelled = KQL.label_size(df, "Table", "GB", max_categories=2, quantile=0.5, max_scale=10, field="big")
+        assert (
+            list(labelled["Table"][:5]) == ["a", "b", "1 Others", "d", "e"]
+            and pandas.isna(labelled["Table"][5])
+            and list(labelled["big"][:6]) == [True, True, False, False, False, False]
+        )
+        assert list(df.columns) == ["Table", "GB"] and df["Table"][2] == "c"
+        wide = pandas.DataFrame({"Password": [5, 1, 9], "SMS": [1, 0, 2], "Voice": [1, 1, 0]}, index=["u1", "u2", "u3"])
+        summed = KQL(Path(".")).rename_and_sort(wide, {"SMS": "Phone", "Voice": "Phone"}, rows=2)
+        assert summed.to_dict() == {"Password": {"u3": 9, "u1": 5}, "Phone": {"u3": 2, "u1": 2}}
+
+    def test_kql2df_stages(self, tmp_path, monkeypatch):
+        queries = []
+
+        def analytics_query(workspaces, query, timespan, strict=False):
+            queries.append((query, timespan))
+            return pandas.DataFrame({"Table": ["a"], "oversized": [False], "IngestionVolume": [1.0]})
+
+        monkeypatch.setattr(KQL, "analytics_query", analytics_query)
+        kp = KQL(fleet_path(tmp_path), time_slices=4)
+        stage = KQL.label_size_kql("Table", "IngestionVolume", by=["TimeGenerated"])
+        kp.kql2df("// split: sum IngestionVolume\nUsage;", workspaces=["ws0"], stages=[stage])
+        # one query (not sliced) with the stage appended
+        assert queries == [("// split: sum IngestionVolume\nUsage" + stage, "P30D")]
+        assert "percentile(_size, 50)) * 10" in stage and stage.endswith("by ['Table'], ['oversized'], ['TimeGenerated']")
+        assert KQL.kql_name("Guest's Domain") == "['Guest\\'s Domain']"
+
+    def test_kql_stages_match_pandas(self):
+        # categories sized 1 to 70 rows, so sums, counts and maxima are distinct and 4 are oversized by count
+        values = iter(range(1, 10**6))
+        rows = [(f"t{k}", next(values) * 0.37 % 10, f"d{i % 3}") for k, n in enumerate([1, 2, 3, 4, 5, 6, 7, 40, 50, 60, 70]) for i in range(n)]
+        df = pandas.DataFrame(rows, columns=["Table", "IngestionVolume", "Day"])
+        for agg in ["sum", "count", "max", "mean"]:
+            options = {"max_categories": 3, "max_scale": 2, "agg": agg}
+            expected = KQL.label_size(df, "Table", "IngestionVolume", **options)
+            labelled = evaluate_kql(df, KQL.label_size_kql("Table", "IngestionVolume", **options))
+            pandas.testing.assert_frame_equal(
+                labelled.sort_values(list(df.columns), ignore_index=True), expected.sort_values(list(df.columns), ignore_index=True)
+            )
+            expected = expected.groupby(["Table", "oversized", "Day"])["IngestionVolume"].agg(agg).reset_index()
+            summarized = evaluate_kql(df, KQL.label_size_kql("Table", "IngestionVolume", by=["Day"], **options))
+            pandas.testing.assert_frame_equal(
+                summarized.sort_values(["Table", "Day"], ignore_index=True), expected.sort_values(["Table", "Day"], ignore_index=True), check_dtype=False
+            )
+        wide = pandas.DataFrame(
+            {"User": [f"u{i}" for i in range(6)], **{c: [next(values) * 0.37 % 10 for _ in range(6)] for c in ["Password", "SMS", "Voice", "FIDO", "App"]}}
+        )
+        # the generated text is pinned too, so changes to it are reviewed against kusto rather than only this evaluator
+        assert KQL.rename_and_sort_kql("User", {"SMS": "Phone"}, rows=3, cols=2).split("\n")[1:] == [
+            "        | evaluate narrow()",
+            "        | as hint.materialized=true _narrow",
+            "        | where Column != 'User'",
+            "        | lookup (_narrow | where Column == 'User' | project Row, _key = Value) on Row",
+            '        | extend Column = coalesce(tostring(dynamic({"SMS": "Phone"})[Column]), Column), Value = todouble(Value)',
+            "        | summarize Value = sum(Value) by _key, Column",
+            "        | as hint.materialized=true _cells",
+            "        | join kind=inner (_cells | summarize _total = sum(Value) by Column | top 2 by _total) on Column",
+            "        | as hint.materialized=true _top",
+            "        | join kind=inner (_top | summarize _total = sum(Value) by _key | top 3 by _total) on _key",
+            "        | evaluate pivot(Column, sum(Value), _key)",
+            "        | project-rename ['User'] = _key",
+        ]
+        kp, names = KQL(Path(".")), {"SMS": "Phone", "Voice": "Phone"}
+        pivoted = evaluate_kql(wide, KQL.rename_and_sort_kql("User", names, rows=3, cols=2))
+        expected = kp.rename_and_sort(wide.set_index("User"), names, rows=3, cols=2)
+        pandas.testing.assert_frame_equal(kp.rename_and_sort(pivoted.set_index("User"), {}), expected, check_names=False)
+        # kusto rejects these, so the subset does too
+        with pytest.raises(ValueError, match="count"):
+            evaluate_kql(df, "| summarize count(IngestionVolume) by Table")
+        with pytest.raises(ValueError, match="coalesce"):
+            evaluate_kql(df, '| extend Table = coalesce(dynamic({"t1": "x"})[Table], Table)')
+
+    def test_iter_queries(self, tmp_path, monkeypatch):
+        def analytics_query(workspaces, query, timespan, strict=False):
+            if query == "Slow":
+                time.sleep(0.5)
+            elif "ws0" not in workspaces:
+                return KQL.no_data_df(query, timespan)
+            return loganalytics.tables2df(api_response)
+
+        monkeypatch.setattr(KQL, "analytics_query", analytics_query)
+        kp = KQL(fleet_path(tmp_path)).set_agency("agency1", sample_agency="agency0")
+        streamed = [(key, len(df), stats[0]) for key, kql, df, stats in kp.iter_queries({"Slow": "Slow", "Fallback": "Fast"})]
+        # fallback section lands (with sample data) before the slow query finishes
+        assert streamed == [("Fallback", 2, 0), ("Slow", 2, 2)]
+        assert kp.querystats["Rows"].to_dict() == {"Fallback": 0, "Slow": 2}
+        assert len(kp.queries["Fallback"][1]) == 2
+
+    def test_scheduler(self, api):
+        scheduler = loganalytics.scheduler(max_inflight=2, backoff=0.01)
+        StubAPI.failures, StubAPI.max_workspaces = [(429, b"{}", {"Retry-After": "0.01"}), (503, b"{}", {})], 8
+        df = KQL.analytics_query(workspaces=[f"ws{i}" for i in range(20)], query="Usage", timespan="P1D")
+        # every workspace still comes back despite throttling and a chunk too big to answer
+        assert sorted(set(df["TenantId"])) == sorted(f"ws{i}" for i in range(20))
+        assert scheduler.counters["retries"] == 2 and scheduler.counters["splits"] == 3 and scheduler.counters["failures"] == 0
+
+    def test_singleton(self):
+        closed, Shared = [], type("Shared", (dict,), {})  # weakly referenceable, for the exit finalizer
+        shared = Singleton(Shared, "Shared dict", close=closed.append, per_process=True)
+        first = shared()
+        assert shared() is first and shared.__doc__ == "Shared dict, created on first use (pass kwargs to replace it)"
+        replaced = shared(a=1)
+        assert replaced == {"a": 1} and closed == [first] and shared() is replaced
+        # a forked child gets its own, configured like the parent's, without closing the parent's
+        shared.pid = -1
+        child = shared()
+        assert child is not replaced and child == {"a": 1} and closed == [first]
+        shared.reset()
+        assert shared() == {}
+
+    def test_atomic_write(self, tmp_path):
+        target = tmp_path / "report.json"
+        target.write_text("old")
+        with pytest.raises(RuntimeError):
+            with atomic_write(target) as tmp:
+                tmp.write_text("partial")
+                raise RuntimeError
+        # a failed write leaves the old file and no temporary behind
+        assert target.read_text() == "old" and list(tmp_path.iterdir()) == [target]
+        with atomic_write(target) as tmp:
+            tmp.write_text("new")
+            assert target.read_text() == "old"
+        assert target.read_text() == "new" and list(tmp_path.iterdir()) == [target]
+
+    def test_time_slices(self, tmp_path, monkeypatch):
+        end = pandas.Timestamp("2022-10-31T10:30:00Z")
+        windows = KQL.split_timespan("P3D", 3, end=end)
+        assert windows == [
+            "2022-10-28T10:30:00Z/2022-10-29T10:00:00Z",
+            "2022-10-29T10:00:00Z/2022-10-30T10:00:00Z",
+            "2022-10-30T10:00:00Z/2022-10-31T10:30:00Z",
+        ]
+        # start/end intervals are split the same way
+        assert KQL.split_timespan("2022-10-28T10:30:00Z/2022-10-31T10:30:00Z", 3) == windows
+        calls = []
+
+        def analytics_query(workspaces, query, timespan, strict=False):
+            calls.append(timespan)
+            # every window sees the same two files, so merged counts are 3x
+            return pandas.DataFrame({"FileUrl": ["a", "b"], "Count": [1, 2], "TableName": "PrimaryResult"})
+
+        monkeypatch.setattr(KQL, "analytics_query", analytics_query)
+        kp = KQL(tmp_path, time_slices=3)
+        kp.sentinelworkspaces = ["ws0"]
+        df = kp.kql2df("// split: sum Count\nOfficeActivity")
+        assert len(calls) == 3 and "/" in calls[0]
+        assert df[["FileUrl", "Count"]].values.tolist() == [["b", 6], ["a", 3]]
+        assert len(kp.kql2df("// split: concat\nOfficeActivity")) == 6
+        calls.clear()
+        kp.kql2df("// split: concat\nOfficeActivity", timespan="2022-10-01/2022-10-04")
+        assert sorted(calls) == [
+            "2022-10-01T00:00:00Z/2022-10-02T00:00:00Z",
+            "2022-10-02T00:00:00Z/2022-10-03T00:00:00Z",
+            "2022-10-03T00:00:00Z/2022-10-04T00:00:00Z",
+        ]
+        # queries without a split header aren't sliced
+        calls.clear()
+        kp.kql2df("OfficeActivity")
+        assert calls == ["P30D"]
+
+    def test_history(self, tmp_path):
+        windows = []
+
+        def run(workspaces, window):
+            # one row per workspace per hour in the window
+            windows.append(window)
+            start, end = (pandas.Timestamp(t) for t in window.split("/"))
+            hours = pandas.date_range(start.ceil("H"), end, freq="H", inclusive="left")
+            return pandas.DataFrame([{"TimeGenerated": h, "TenantId": ws, "IngestionVolume": 1.0} for ws in workspaces for h in hours])
+
+        store = HistoryStore(tmp_path, retention="P10D")
+        now = pandas.Timestamp("2022-10-31T06:00:00Z")
+        store.refresh("Usage", ["ws0", "ws1"], run, now=now)
+        assert windows == ["2022-10-21T00:00:00Z/2022-10-31T06:00:00Z"]
+        # next refresh only queries from the start of the last refreshed day
+        store.refresh("Usage", ["ws0", "ws1"], run, now=now + pandas.Timedelta("1D"))
+        assert windows[-1] == "2022-10-31T00:00:00Z/2022-11-01T06:00:00Z"
+        df = store.load("Usage", ["ws0"])
+        assert len(df) == len(df.drop_duplicates()) == 10 * 24 + 6  # 10-21 pruned, 10-22 to 11-01 06:00
+        assert store.watermark("Usage", "ws1") == pandas.Timestamp("2022-11-01T00:00:00Z")
+        # partitions past retention are pruned
+        store.refresh("Usage", ["ws0", "ws1"], run, now=now + pandas.Timedelta("5D"))
+        assert min(p.stem for p in store.partitions("Usage", "ws0")) == "2022-10-26"
+
+    def test_history_failed_window(self, tmp_path):
+        def run(workspaces, window):
+            start, end = (pandas.Timestamp(t) for t in window.split("/"))
+            if start == pandas.Timestamp("2022-10-27T00:00:00Z") and not retried:
+                raise loganalytics.QueryError("simulated failure", "transient")
+            days = pandas.date_range(start, end, freq="D", inclusive="left")
+            return pandas.DataFrame([{"TimeGenerated": d, "TenantId": ws, "Count": 1} for ws in workspaces for d in days])
+
+        store, now, retried = HistoryStore(tmp_path, retention="P10D", max_window="P3D"), pandas.Timestamp("2022-10-31T06:00:00Z"), False
+        store.refresh("Usage", ["ws0"], run, now=now)
+        # 10-21/10-24 and 10-24/10-27 succeeded, so the watermark stops at the failed window, though later windows are stored
+        assert store.watermark("Usage", "ws0") == pandas.Timestamp("2022-10-27T00:00:00Z")
+        assert "2022-10-27" not in [p.stem for p in store.partitions("Usage", "ws0")] and "2022-10-30" in [p.stem for p in store.partitions("Usage", "ws0")]
+        retried = True
+        store.refresh("Usage", ["ws0"], run, now=now)
+        assert store.watermark("Usage", "ws0") == pandas.Timestamp("2022-10-31T00:00:00Z") and len(store.partitions("Usage", "ws0")) == 11
+
+    def test_kql2df_history(self, tmp_path, monkeypatch):
+        def analytics_query(workspaces, query, timespan, strict=False):
+            start, end = (pandas.Timestamp(t) for t in timespan.split("/"))
+            days = pandas.date_range(start.ceil("D"), end, freq="D", inclusive="left")
+            return pandas.DataFrame([{"TimeGenerated": d, "TenantId": ws, "Count": 1} for ws in workspaces for d in days])
+
+        monkeypatch.setattr(KQL, "analytics_query", analytics_query)
+        kp = KQL(tmp_path, history="P90D")
+        kp.sentinelworkspaces = ["ws0"]
+        query = "// history: TimeGenerated\nEmailEvents"
+        assert len(kp.kql2df(query)) in (30, 31)
+        assert len(kp.history(query)) in (90, 91)
+        iso = lambda t: t.strftime("%Y-%m-%dT%H:%M:%SZ")
+        now = pandas.Timestamp.utcnow().floor("D")
+        assert len(kp.kql2df(query, timespan=f"{iso(now - pandas.Timedelta('10D'))}/{iso(now - pandas.Timedelta('5D'))}")) == 6
+        with pytest.raises(ValueError, match="start/end interval"):
+            kp.history(query, since="last month")
+
+    def test_hash_columns(self, monkeypatch):
+        monkeypatch.setattr(KQL, "hash_salt", "pepper")
+        monkeypatch.setattr(KQL, "hash_memo", {})
+        df = pandas.DataFrame({"user": ["alice", "bob", None, "alice"], "devices": ["a, b", "c", "d", "a, b"]})
+        KQL.hash_columns(df, ["user", "devices"])
+        assert df["user"][0] == df["user"][3] != df["user"][1] and pandas.isna(df["user"][2])
+        assert len(df["devices"][0]) == 16
+        token = df["user"][0]
+        # tokens are stable without the memo, and a different salt gives different tokens
+        KQL.hash_memo.clear()
+        assert KQL.hash_values(pandas.Series(["alice"]))[0] == token
+        # tokens of other lengths come from the same memo
+        assert (
+            KQL.hash_values(pandas.Series(["alice"]), truncate=32)[0].startswith(token) and len(KQL.hash_values(pandas.Series(["alice"]), truncate=8)[0]) == 8
+        )
+        monkeypatch.setattr(KQL, "hash_salt", "salt")
+        assert KQL.hash_values(pandas.Series(["alice"]))[0] != token
+        monkeypatch.setattr(KQL, "hash_salt", "")
+        with pytest.warns(UserWarning, match="REPORT_HASH_SALT"):
+            KQL.hash_values(pandas.Series(["alice"]))
+
+    def test_discover_workspaces(self, monkeypatch):
+        pages = {
+            "": {"data": [{"customerId": f"ws{i}"} for i in range(1000)], "skip_token": "next"},
+            "next": {"data": [{"customerId": "ws1000"}], "skip_token": None},
+        }
+
+        def azcli(cmd, df=False):
+            if cmd[:2] == ["graph", "query"]:
+                return pages[cmd[cmd.index("--skip-token") + 1] if "--skip-token" in cmd else ""]
+
+        monkeypatch.setattr(azure_notebook_reporting, "azcli", azcli)
+        assert len(KQL.discover_workspaces()) == 1001
+
+    def test_workspace_registry(self, tmp_path, monkeypatch):
+        validated = []
+
+        def analytics_query(workspaces, query, timespan, strict=False):
+            assert strict  # partial results would mark a failed chunk's workspaces validated
+            validated.append(sorted(workspaces))
+            if "ws3" in workspaces:
+                raise loganalytics.QueryError("503", "transient")
+            return pandas.DataFrame({"TenantId": workspaces[:1], "LastAlert": [pandas.Timestamp.utcnow()]})
+
+        monkeypatch.setattr(KQL, "discover_workspaces", lambda: [{"customerId": "ws0"}, {"customerId": "ws1"}])
+        monkeypatch.setattr(KQL, "analytics_query", analytics_query)
+        registry = tmp_path / "WorkspaceRegistry.csv"
+        assert KQL.list_workspaces(registry) == ["ws0"]
+        # a new workspace is the only one validated on the next run
+        monkeypatch.setattr(KQL, "discover_workspaces", lambda: [{"customerId": "ws0"}, {"customerId": "ws1"}, {"customerId": "ws2"}])
+        assert KQL.list_workspaces(registry) == ["ws0", "ws2"]
+        assert validated == [["ws0", "ws1"], ["ws2"]]
+        # a failed validation leaves the new workspace pending, and it's retried next run
+        monkeypatch.setattr(KQL, "discover_workspaces", lambda: [{"customerId": f"ws{i}"} for i in range(4)])
+        df = KQL.update_registry(registry)
+        assert df.set_index("customerId")["Validated"].isna().to_dict() == {"ws0": False, "ws1": False, "ws2": False, "ws3": True}
+        assert KQL.list_workspaces(registry) == ["ws0", "ws2"] and validated[-2:] == [["ws3"], ["ws3"]]
+        # KQL loads the registry rather than discovering
+        (tmp_path / "notebooks" / "lists").mkdir(parents=True)
+        registry.rename(tmp_path / "notebooks" / "lists" / "WorkspaceRegistry.csv")
+        monkeypatch.setattr(KQL, "discover_workspaces", None)
+        assert KQL(tmp_path).sentinelworkspaces == ["ws0", "ws2"]
+
+    def test_lazy_construction(self, tmp_path, monkeypatch):
+        calls = []
+        monkeypatch.setattr(azure_notebook_reporting, "azcli", lambda cmd, df=False: calls.append(cmd))
+        monkeypatch.setattr(azure_notebook_reporting, "azcli_extensions", set())
+        monkeypatch.setattr(KQL, "list_workspaces", lambda registry: calls.append("list_workspaces") or ["ws0"])
+        kp = KQL(tmp_path)
+        assert calls == []
+        assert kp.sentinelworkspaces == ["ws0"] and kp.sentinelworkspaces == ["ws0"]
+        assert calls == ["list_workspaces"]
+        # extensions are added once, and not at all if already installed
+        monkeypatch.setenv("AZURE_EXTENSION_DIR", str(tmp_path))
+        (tmp_path / "resource-graph").mkdir()
+        for _ in range(2):
+            azure_notebook_reporting.azcli_extension("log-analytics")
+            azure_notebook_reporting.azcli_extension("resource-graph")
+        assert calls == ["list_workspaces", ["extension", "add", "-n", "log-analytics", "-y"]]
@@ -0,0 +1,163 @@
+import json, os, pickle, subprocess, sys, time, tracemalloc, pandas, pytest
+from azure_notebook_reporting import loganalytics, rendering, KQL, SharedStore
+
+# BENCHMARK=1 pytest tests/test_benchmarks.py -s
+pytestmark = pytest.mark.skipif(not os.environ.get("BENCHMARK"), reason="set BENCHMARK=1 to run benchmarks")
+rows = int(os.environ.get("BENCHMARK_ROWS", 1000000))
+
+columns = [
+    {"name": "TimeGenerated", "type": "datetime"},
+    {"name": "UserPrincipalName", "type": "string"},
+    {"name": "ResultType", "type": "long"},
+    {"name": "Duration", "type": "real"},
+    {"name": "IsInteractive", "type": "bool"},
+    {"name": "AuthenticationDetails", "type": "dynamic"},
+]
+
+
+def synthetic_rows(n: int) -> list:
+    "Sign in shaped rows, with repeated users like a real SigninLogs export"
+    start = pandas.Timestamp("2022-10-01").value // 10**9
+    return [
+        [pandas.Timestamp(start + i, unit="s").strftime("%Y-%m-%dT%H:%M:%SZ"), f"user{i % 5000}@example.com", i % 7, i / 3, i % 2 == 0, '{"method":"Password"}']
+        for i in range(n)
+    ]
+
+
+def legacy_decode(text: str) -> pandas.DataFrame:
+    "The azcli path: read_json, to_numeric per column, to_datetime, convert_dtypes"
+    df = pandas.read_json(text)
+    df = df[df.columns].apply(pandas.to_numeric, errors="ignore")
+    df["TimeGenerated"] = pandas.to_datetime(df["TimeGenerated"])
+    return df.convert_dtypes()
+
+
+startup = """
+import sys, time
+start = time.perf_counter()
+from azure_notebook_reporting import KQL
+imported = time.perf_counter()
+kp = KQL(__import__("pathlib").Path(sys.argv[1]))
+constructed = time.perf_counter()
+kp.sentinelworkspaces, KQL.base_css
+print(imported - start, constructed - imported, time.perf_counter() - constructed, "seaborn" in sys.modules)
+"""
+
+
+def legacy_label_size(dataframe: pandas.DataFrame, category: str, metric: str, max_categories=9, quantile=0.5, max_scale=10, agg="sum"):
+    "Deep copy, then a replace per others group"
+    df = dataframe.copy(deep=True)
+    sizes = df.groupby(category)[metric].agg(agg).sort_values(ascending=False)
+    maxmetric = sizes.quantile(quantile) * max_scale
+    normal, oversized = sizes[sizes <= maxmetric], sizes[sizes > maxmetric]
+    df["oversized"] = df[category].isin(oversized.index)
+    for others in (normal[max_categories:], oversized[max_categories:]):
+        df[category] = df[category].replace({label: f"{others.count()} Others" for label in others.index})
+    return df
+
+
+def legacy_excel(dfs: dict, excel_file):
+    "pandas.ExcelWriter in default mode, holding the workbook in memory until close"
+    with pandas.ExcelWriter(excel_file, engine="xlsxwriter") as writer:
+        for name, df in dfs.items():
+            df = df.copy()
+            df["TimeGenerated"] = df["TimeGenerated"].dt.tz_localize(None)
+            df.drop("TableName", axis=1).to_excel(writer, sheet_name=name)
+
+
+def peak_memory(fn, *args):
+    tracemalloc.start()
+    result, secs = timed(fn, *args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, secs, peak / 1e6
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+class TestBenchmarks:
+    def test_decode(self):
+        data = synthetic_rows(rows)
+        names = [c["name"] for c in columns] + ["TableName"]
+        legacy_text = json.dumps([dict(zip(names, row + ["PrimaryResult"])) for row in data])
+        api_text = json.dumps({"tables": [{"name": "PrimaryResult", "columns": columns, "rows": data}]})
+        del data
+        legacy, legacy_secs = timed(legacy_decode, legacy_text)
+        typed, typed_secs = timed(lambda text: loganalytics.tables2df(json.loads(text)), api_text)
+        legacy_mb, typed_mb = legacy.memory_usage(deep=True).sum() / 1e6, typed.memory_usage(deep=True).sum() / 1e6
+        print(f"\n{rows} rows: legacy {legacy_secs:.2f}s {legacy_mb:.0f}MB, typed arrow {typed_secs:.2f}s {typed_mb:.0f}MB")
+        assert typed_secs < legacy_secs and typed_mb < legacy_mb
+
+    def test_concat(self):
+        # 50 chunks of 20 workspaces, concatenated in arrow then converted once vs per chunk pandas frames
+        response = {"tables": [{"name": "PrimaryResult", "columns": columns, "rows": synthetic_rows(rows // 50)}]}
+        chunks = [loganalytics.tables2arrow(response) for _ in range(50)]
+        frames = [loganalytics.arrow2df([chunk]) for chunk in chunks]
+        (legacy, legacy_secs), (typed, typed_secs) = timed(pandas.concat, frames), timed(loganalytics.arrow2df, chunks)
+        print(f"\nconcat {len(typed)} rows: pandas {legacy_secs:.3f}s, arrow {typed_secs:.3f}s")
+        assert len(typed) == len(legacy)
+
+    def test_hash_columns(self):
+        # sample data sections hash user and device columns with many repeated values
+        df = pandas.DataFrame({"user": [f"user{i % 5000}@example.com" for i in range(rows // 2)]})
+        legacy, legacy_secs = timed(lambda: df["user"].apply(KQL.hash256))
+        KQL.hash_memo.clear()
+        vectorised, vectorised_secs = timed(KQL.hash_values, df["user"])
+        print(f"\nhash {len(df)} rows: apply(hash256) {legacy_secs:.2f}s, hash_values {vectorised_secs:.2f}s")
+        assert vectorised_secs < legacy_secs and vectorised.nunique() == legacy.nunique()
+
+    def test_startup(self, tmp_path):
+        # fresh interpreter per run, as a papermill kernel starts one
+        lists = tmp_path / "notebooks" / "lists"
+        lists.mkdir(parents=True)
+        pandas.DataFrame({"customerId": [f"ws{i}" for i in range(1000)], "SecOps Group": [f"agency{i % 100}" for i in range(1000)]}).to_csv(
+            lists / "SentinelWorkspaces.csv", index=False
+        )
+        pandas.DataFrame({"Alias": [f"agency{i}" for i in range(100)], "Primary agency": [f"Agency {i}" for i in range(100)]}).to_csv(
+            lists / "SecOps Groups.csv", index=False
+        )
+        output = subprocess.check_output([sys.executable, "-c", startup, str(tmp_path)], text=True).split()
+        imported, constructed, first_use = map(float, output[:3])
+        print(f"\nimport {imported:.2f}s, KQL() {constructed * 1000:.1f}ms, first use of workspaces and css {first_use:.2f}s")
+        assert output[3] == "False" and constructed < first_use
+
+    def test_excel(self, tmp_path):
+        # a raw sign in table, excel export is much slower than decoding so use a tenth of the rows
+        df = loganalytics.tables2df({"tables": [{"name": "PrimaryResult", "columns": columns, "rows": synthetic_rows(rows // 10)}]})
+        _, legacy_secs, legacy_mb = peak_memory(legacy_excel, {"SignIns": df}, tmp_path / "legacy.xlsx")
+        _, streamed_secs, streamed_mb = peak_memory(rendering.write_excel, {"SignIns": df}, tmp_path / "streamed.xlsx")
+        print(f"\nexcel {len(df)} rows: ExcelWriter {legacy_secs:.2f}s peak {legacy_mb:.0f}MB, constant_memory {streamed_secs:.2f}s peak {streamed_mb:.0f}MB")
+        assert streamed_mb < legacy_mb
+
+    def test_label_size(self):
+        # hourly ingestion for 300 tables, most of them small
+        df = pandas.DataFrame(
+            {
+                "Table": pandas.array([f"Table{i % 300}" for i in range(rows // 2)], dtype="string[pyarrow]"),
+                "GB": [float(i % 300) ** 2 for i in range(rows // 2)],
+            }
+        )
+        legacy, legacy_secs = timed(legacy_label_size, df, "Table", "GB")
+        labelled, labelled_secs = timed(KQL.label_size, df, "Table", "GB")
+        print(f"\nlabel_size {len(df)} rows: copy and replace {legacy_secs:.2f}s, category codes {labelled_secs:.2f}s")
+        assert labelled_secs < legacy_secs and (labelled["Table"] == legacy["Table"]).all()
+
+    def test_shared_store(self, tmp_path):
+        # a sample agency result, as shipped to each render worker: pickled per worker vs published once and memory mapped
+        df = loganalytics.tables2df({"tables": [{"name": "PrimaryResult", "columns": columns, "rows": synthetic_rows(rows // 2)}]})
+        pickled, pickle_secs = timed(pickle.dumps, df)
+        _, unpickle_secs = timed(pickle.loads, pickled)
+        with SharedStore(tmp_path / "shared") as store:
+            name, publish_secs = timed(store.publish, df)
+            attached, attach_secs = timed(store.attach, name)
+            print(
+                f"\nshare {len(df)} rows: pickle {pickle_secs + unpickle_secs:.2f}s and {len(pickled) / 1e6:.0f}MB per worker,"
+                f" publish once {publish_secs:.2f}s, attach {attach_secs:.2f}s"
+            )
+            assert attached.equals(df)
+            # below ~100k rows both take milliseconds and the comparison is noise
+            assert len(df) < 100000 or attach_secs < unpickle_secs + pickle_secs
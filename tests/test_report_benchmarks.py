@@ -0,0 +1,71 @@
+import multiprocessing, os, resource, shutil, pandas, pytest
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from azure_notebook_reporting import loganalytics, rendering, KQL, SimulatedBackend
+
+# BENCHMARK=1 pytest tests/test_report_benchmarks.py --benchmark-only
+# end to end fleet report generation against the simulated backend, see .github/workflows/ci.yml
+pytestmark = pytest.mark.skipif(not os.environ.get("BENCHMARK"), reason="set BENCHMARK=1 to run benchmarks")
+siemhealth = Path(__file__).parent.parent / "notebooks" / "kql" / "siemhealth"
+# the 100 agency run takes minutes, so it's left to the scheduled benchmark job (BENCHMARK_AGENCIES=1,10,100)
+fleet_sizes = [int(n) for n in os.environ.get("BENCHMARK_AGENCIES", "1,10").split(",")]
+
+
+def fleet(tmp_path: Path, agencies: int, workspaces: int = 3) -> Path:
+    "Lists for agencies x workspaces, and the siemhealth queries"
+    nbpath = tmp_path / "notebooks"
+    (nbpath / "lists").mkdir(parents=True)
+    shutil.copytree(siemhealth, nbpath / "kql" / "siemhealth")
+    rows = [{"customerId": f"ws{a}-{w}", "SecOps Group": f"agency{a}"} for a in range(agencies) for w in range(workspaces)]
+    pandas.DataFrame(rows).to_csv(nbpath / "lists" / "SentinelWorkspaces.csv", index=False)
+    groups = [{"Alias": f"agency{a}", "Primary agency": f"Agency {a}"} for a in range(agencies)]
+    pandas.DataFrame(groups).to_csv(nbpath / "lists" / "SecOps Groups.csv", index=False)
+    return tmp_path
+
+
+def render(kp: KQL):
+    "The cpu heavy parts of a report notebook: labelling ingestion, a chart and the excel export (pdf layout needs weasyprint)"
+    kp.report_title = "Benchmark"
+    usage = kp.queries["Usage"][1]
+    if not KQL.no_data(usage):
+        usage = KQL.label_size(usage, "Table", "IngestionVolume")
+        daily = usage.groupby([usage["TimeGenerated"].dt.floor("D"), "Table"])["IngestionVolume"].sum().unstack("Table")
+        rendering.render_figure(daily, {"kind": "area", "stacked": True})
+    kp.report_files()
+    rendering.write_excel(kp.excel_sheets(), kp.excel_file)
+    return kp.querystats["Rows"].sum()
+
+
+def report(path: Path) -> dict:
+    kp = KQL(path)
+    queries = {f.stem.title(): f"siemhealth/{f.name}" for f in sorted(siemhealth.glob("*.kql"))}
+    reports = kp.load_queries_fleet(queries, sample_agency="agency0")
+    return KQL.render_fleet(reports, render, max_workers=4)
+
+
+def peak_memory(path: Path) -> dict:
+    "Peak rss (MB) of one fleet report run and of its largest render worker, measured in the fresh process this runs in"
+    KQL.backend = SimulatedBackend(latency=0.005, failure_rate=0.02, rows=20)
+    loganalytics.scheduler(backoff=0.001)
+    report(path)
+    return {
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "max_worker_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+@pytest.mark.parametrize("agencies", fleet_sizes)
+def test_fleet_report(benchmark, tmp_path, monkeypatch, agencies):
+    monkeypatch.setattr(KQL, "backend", SimulatedBackend(latency=0.005, failure_rate=0.02, rows=20))
+    loganalytics.scheduler(backoff=0.001)
+    path = fleet(tmp_path, agencies)
+    try:
+        outputs = benchmark.pedantic(report, args=(path,), rounds=3 if agencies < 100 else 1)
+    finally:
+        loganalytics.scheduler.reset()
+        loganalytics.telemetry.reset()
+    benchmark.extra_info["requests"] = KQL.backend.requests
+    assert len(outputs) == agencies and all(rows > 0 for rows in outputs.values())
+    # ru_maxrss is a high water mark for the whole process, so memory is measured in a new one per fleet size (see ci.yml)
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        benchmark.extra_info.update(executor.submit(peak_memory, path).result())